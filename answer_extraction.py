@@ -0,0 +1,257 @@
+import collections
+import math
+import re
+import threading
+import time
+
+LABELS = "ABCDE"  # 选项标签
+
+# 推理块：闭合的 <think>...</think>，以及被截断、没有 </think> 的 <think> 到结尾的部分
+_THINK_BLOCK = re.compile(r'<think>.*?</think>', re.DOTALL)
+_THINK_UNCLOSED = re.compile(r'<think>.*\Z', re.DOTALL)
+
+
+def build_patterns(labels=LABELS):
+    """
+    按优先级排列的答案模式，每项为 (名称, 预编译的正则, 是否取最后一个匹配)：
+    - answer_statement：按提示要求的格式 The best answer is: "(X) ..."，取最后一次，reflection 会在最后重述答案；
+      只有 "answer is" 不区分大小写，选项标签必须大写，与其他模式一致；
+    - label_in_parens：回答中第一个只含选项标签的括号 (X)，不会匹配 "(the content" 之类的括号文字；
+    - loose_label："X) "、"X. " 等宽松格式（原 output_fix.extract_model_ans 的规则）。
+    """
+    label_class = f"[{re.escape(labels)}]"
+    return [
+        ("answer_statement", re.compile(rf'(?i:answer is)[:\s"“]*\(\s*({label_class})\s*\)'), True),
+        ("label_in_parens", re.compile(rf'\(\s*({label_class})\s*\)'), False),
+        ("loose_label", re.compile(rf'[\("]?({label_class})[\)\.][ ]'), False),
+    ]
+
+
+def strip_reasoning(text, truncated=True):
+    """
+    去掉回答中的 <think> 推理块。
+    Args:
+        truncated (bool): 为 True 时，没有 </think> 的 <think> 之后的内容也视为推理块去掉。
+    """
+    if "<think>" not in text:
+        return text
+    text = _THINK_BLOCK.sub("", text)
+    if truncated:
+        text = _THINK_UNCLOSED.sub("", text)
+    return text
+
+
+def label_distribution(top_logprobs, labels=LABELS):
+    """
+    把一个 token 位置的 top_logprobs 合并为选项标签的概率分布。
+    "A"、" A"、"(A" 等写法视为同一个标签，概率相加；只接受大写标签，小写的 "a" 通常是单词。
+    Args:
+        top_logprobs (list): [(token, logprob)]。
+    Returns:
+        tuple: (标签 -> 在选项标签之间归一化的概率，按 labels 顺序，只含出现过的标签；
+                选项标签在 top_logprobs 中所占的总概率，越接近 1 说明模型越遵守只输出标签的要求)。
+    """
+    mass = collections.Counter()
+    for token, logprob in top_logprobs:
+        label = token.strip().lstrip("(\"'").strip()
+        if len(label) == 1 and label in labels:
+            mass[label] += math.exp(logprob)
+    total = sum(mass.values())
+    if total == 0:
+        return {}, 0.0
+    return {label: mass[label] / total for label in labels if label in mass}, total
+
+
+def argmax_label(label_probs):
+    """
+    概率最大的选项标签，概率相同时取靠前的标签；分布为空时返回 ""。
+    """
+    return max(label_probs, key=label_probs.get) if label_probs else ""
+
+
+def majority_label(labels):
+    """
+    多数投票，忽略空标签；票数相同时取最先出现的标签。没有有效标签时返回 ""。
+    """
+    most_common = collections.Counter(label for label in labels if label).most_common(1)
+    return most_common[0][0] if most_common else ""
+
+
+class AnswerExtractor:
+    """
+    从回答中提取选项标签：先去掉推理块，再按顺序尝试各模式，用第一个命中的模式的结果。
+    统计每个模式的命中次数（未命中记为 "none"），线程安全。
+    """
+
+    def __init__(self, labels=LABELS):
+        self.patterns = build_patterns(labels)
+        self._hits = collections.Counter()
+        self._lock = threading.Lock()
+
+    def match(self, text):
+        """
+        Returns:
+            tuple: (选项标签, 命中的模式名称)，无法提取时为 ("", None)。不计入统计。
+        """
+        if not text or not isinstance(text, str):
+            return "", None
+        text = strip_reasoning(text)
+        for name, pattern, use_last in self.patterns:
+            if use_last:
+                found = None
+                for found in pattern.finditer(text):
+                    pass
+            else:
+                found = pattern.search(text)
+            if found:
+                return found.group(1), name
+        return "", None
+
+    def extract(self, text):
+        """
+        提取单个回答的选项标签，无法提取时返回 ""。
+        """
+        label, name = self.match(text)
+        with self._lock:
+            self._hits[name or "none"] += 1
+        return label
+
+    def extract_batch(self, texts):
+        """
+        批量提取，texts 可以是列表或任何可迭代的列（如 pyarrow / numpy 数组）。
+        Returns:
+            list: 与 texts 一一对应的选项标签。
+        """
+        if hasattr(texts, "to_pylist"):
+            texts = texts.to_pylist()
+        results = [self.match(text) for text in texts]
+        with self._lock:
+            self._hits.update(name or "none" for _, name in results)
+        return [label for label, _ in results]
+
+    def extract_votes(self, text):
+        """
+        自一致性的合并回答：每行为一次投票（与保存格式相同），逐行提取后多数投票。
+        """
+        return majority_label(self.extract_batch(text.strip().split("\n")))
+
+    def stats(self):
+        """
+        Returns:
+            dict: 模式名称 -> 命中次数，按模式顺序排列，最后是未命中的次数 "none"。
+        """
+        with self._lock:
+            return {name: self._hits[name] for name in [p[0] for p in self.patterns] + ["none"]}
+
+    def reset(self):
+        with self._lock:
+            self._hits.clear()
+
+    def report(self):
+        """
+        返回各模式命中情况的文字描述。
+        """
+        stats = self.stats()
+        total = sum(stats.values())
+        if total == 0:
+            return "答案提取：没有提取任何回答"
+        parts = ", ".join(f"{name} {count} ({count / total:.1%})" for name, count in stats.items())
+        return f"答案提取：共 {total} 个回答，{parts}"
+
+
+class StreamingAnswerParser:
+    """
+    流式回答的增量解析：把推理（<think> 块或单独的 reasoning_content 字段）和回答正文分开，
+    在回答正文中按与 AnswerExtractor 相同的规则确定选项标签：取最后一个 answer_statement，
+    没有时取第一个 label_in_parens。
+    只有 answer_statement 可以提前结束读取：最后一个 answer_statement 之后再接收 grace_chars 个字符即可结束，
+    宽限窗口内出现新的 answer_statement 时以新的为准；只有 label_in_parens 时读完整个回答，
+    因为后面出现的 answer_statement 会取代它。
+    """
+
+    def __init__(self, grace_chars=32, extractor=None):
+        self.grace_chars = grace_chars
+        patterns = {name: pattern for name, pattern, _ in (extractor or default_extractor).patterns}
+        self._statement_pattern = patterns["answer_statement"]
+        self._parens_pattern = patterns["label_in_parens"]
+        self.content = ""  # 收到的全部 content，与非流式响应的 message.content 对应
+        self.reasoning = ""  # reasoning_content 字段中的推理内容
+        self.first_token_at = None  # 收到第一个非空增量的时间 (time.perf_counter())
+        self.label = ""
+        self._answer_start = None  # content 中回答正文的起始位置，推理块结束前为 None
+        self._scanned = 0  # 已经查找过标签的位置
+        self._label_end = None  # 最后一个 answer_statement 的结束位置
+
+    def feed(self, content=None, reasoning=None):
+        """
+        处理一个增量。
+        Returns:
+            bool: 已经解析到选项标签且过了宽限窗口，可以结束读取时为 True。
+        """
+        if (content or reasoning) and self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        if reasoning:
+            self.reasoning += reasoning
+        if not content:
+            return self.done()
+        self.content += content
+
+        if self._answer_start is None:
+            head = self.content.lstrip()
+            if head.startswith("<think>"):
+                end = self.content.find("</think>")
+                if end < 0:
+                    return False
+                self._answer_start = end + len("</think>")
+            elif len(head) >= len("<think>") or not "<think>".startswith(head):
+                self._answer_start = 0
+            else:
+                return False  # 可能是还没收完的 "<think>"
+            self._scanned = self._answer_start
+
+        # 从上次查找位置往前留一点重叠，标签可能跨越两个增量；重叠部分再次匹配到的是同一个标签
+        start = max(self._answer_start, self._scanned - 64)
+        for found in self._statement_pattern.finditer(self.content, start):
+            self.label = found.group(1)
+            self._label_end = found.end()
+        if self._label_end is None and not self.label:
+            found = self._parens_pattern.search(self.content, start)
+            if found:
+                self.label = found.group(1)
+        self._scanned = len(self.content)
+        return self.done()
+
+    def done(self):
+        return self._label_end is not None and len(self.content) - self._label_end >= self.grace_chars
+
+    @property
+    def reasoning_length(self):
+        """
+        推理字符数：<think> 块的内容加上 reasoning_content 字段。
+        """
+        think_chars = 0
+        if self._answer_start:
+            head = self.content[:self._answer_start]
+            think_chars = len(head.strip()) - len("<think>") - len("</think>")
+        elif self._answer_start is None and self.content.lstrip().startswith("<think>"):
+            think_chars = len(self.content.lstrip()) - len("<think>")  # 推理块被截断
+        return len(self.reasoning) + max(think_chars, 0)
+
+    @property
+    def full_text(self):
+        """
+        推理和回答合在一起的全部输出，reasoning_content 以 <think> 块的形式放在前面，用于估计 token 数。
+        """
+        return f"<think>{self.reasoning}</think>{self.content}" if self.reasoning else self.content
+
+
+# 共享的默认提取器，pipeline 和 output_fix 都使用它
+default_extractor = AnswerExtractor()
+
+
+def extract_label(text):
+    return default_extractor.extract(text)
+
+
+def extract_batch(texts):
+    return default_extractor.extract_batch(texts)
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import time
+
+# 批处理接口的请求地址
+BATCH_URL = "/v1/chat/completions"
+
+
+def make_custom_id(qa_id, protocol_type, method, vote_index=0):
+    """
+    构造批处理请求的 custom_id："{问题id}|{协议}|{方法，无方法时为 none}|{投票序号}"。
+    同一个 (问题, 协议, 方法, 投票) 每次导出得到相同的 custom_id，导入时据此对应回原问题。
+    """
+    return f"{qa_id}|{protocol_type}|{method or 'none'}|{vote_index}"
+
+
+def parse_custom_id(custom_id):
+    """
+    解析 custom_id。问题 id 本身可能含有 "|"，因此从右侧拆分。
+    Returns:
+        tuple: (问题id, 协议, 方法, 投票序号)，方法为 none 时返回 ""。
+    """
+    qa_id, protocol_type, method, vote_index = custom_id.rsplit("|", 3)
+    return qa_id, protocol_type, "" if method == "none" else method, int(vote_index)
+
+
+def make_batch_request(custom_id, body):
+    """
+    构造批处理输入文件中的一行。
+    Args:
+        custom_id (str): 请求标识。
+        body (dict): chat.completions 的请求体。
+    """
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_URL, "body": body}
+
+
+def write_batch_input(path, requests):
+    """
+    写入批处理输入 JSONL 文件。先写临时文件再替换，避免上传残缺的文件。
+    Returns:
+        int: 写入的请求数。
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    count = 0
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for request in requests:
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+            count += 1
+    os.replace(tmp_path, path)
+    return count
+
+
+def read_batch_output(path):
+    """
+    读取批处理输出 JSONL 文件。
+    Returns:
+        dict: custom_id -> 回答内容；请求失败（error 非空或状态码不是 200）的为 None。
+    """
+    results = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            content = None
+            if not record.get("error") and response.get("status_code") == 200:
+                try:
+                    content = response["body"]["choices"][0]["message"]["content"]
+                except (KeyError, IndexError, TypeError):
+                    content = None
+            results[record["custom_id"]] = content
+    return results
+
+
+def _fake_answer(custom_id, body):
+    """
+    根据 custom_id 确定性地挑选一个选项，生成 "(X) ..." 格式的回答。
+    """
+    prompt = body["messages"][-1]["content"]
+    labels = [label for label in "ABCDE" if f"({label})" in prompt] or ["A"]
+    digest = hashlib.sha1(custom_id.encode("utf-8")).digest()
+    label = labels[digest[0] % len(labels)]
+    return f"The best answer is: ({label}) option {label}"
+
+
+def write_fake_batch_output(input_path, output_path, error_rate=0.0):
+    """
+    为批处理输入文件生成格式相同的本地输出文件，用于离线测试导入流程。
+    Args:
+        input_path (str): 批处理输入文件。
+        output_path (str): 要生成的输出文件。
+        error_rate (float): 按 custom_id 确定性地让这一比例的请求返回错误。
+    Returns:
+        int: 写入的记录数。
+    """
+    count = 0
+    with open(input_path, "r", encoding="utf-8") as fin, open(output_path, "w", encoding="utf-8") as fout:
+        for line in fin:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            custom_id = request["custom_id"]
+            record = {"id": f"batch_req_{count}", "custom_id": custom_id, "response": None, "error": None}
+            if int(hashlib.sha1(custom_id.encode("utf-8")).hexdigest()[-4:], 16) / 0xFFFF < error_rate:
+                record["error"] = {"code": "server_error", "message": "fake batch error"}
+            else:
+                content = _fake_answer(custom_id, request["body"])
+                record["response"] = {
+                    "status_code": 200,
+                    "request_id": f"req_{count}",
+                    "body": {
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": request["body"]["model"],
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                                     "finish_reason": "stop"}],
+                    },
+                }
+            fout.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    # 为 batch/ 下所有还没有输出的输入文件生成本地输出
+    root_dir = "batch"
+    for subdir, _, files in os.walk(root_dir):
+        for filename in files:
+            if filename.endswith(".input.jsonl"):
+                input_file = os.path.join(subdir, filename)
+                output_file = input_file[:-len(".input.jsonl")] + ".output.jsonl"
+                if not os.path.exists(output_file):
+                    n = write_fake_batch_output(input_file, output_file)
+                    print(f"{output_file}: 生成了 {n} 条本地输出。")
@@ -0,0 +1,266 @@
+import contextlib
+import functools
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+
+# 端到端吞吐基准：用进程内的模拟客户端代替 API，测量 main_experiment 的调度、提示构造、解析和保存开销。
+# 每个 (问题数, 方法) 组合在单独的子进程中运行，峰值内存互不影响。
+
+sizes = [500, 5000, 50000]  # 问题数
+methods = ["", "role", "reflection", "self-consistency"]  # 缓解方法，"" 为不使用方法
+num_workers = 32  # main_experiment 的线程数
+mock_latency = 0.0  # 模拟客户端每次请求的延迟（秒），为 0 时只测本地开销
+worker_sample = 200  # 单线程直接调用 worker_run_protocol 的问题数，用于测量单个问题的开销
+output_file = os.path.join("benchmark", "benchmark_results.json")
+baseline_file = os.path.join("benchmark", "baseline.json")
+compare = True  # 运行结束后与 baseline_file 比较
+update_baseline = False  # 为 True 时把本次结果保存为新的基准
+regression_threshold = 0.10  # 吞吐下降或耗时增加超过该比例时标记为退化
+
+# 统计的 CPU 阶段及其对应的 pipeline 函数；"类名.方法名" 表示 pipeline 中导入的类的方法。
+# 答案提取和保存都在结果写入器的后台线程中进行：_finalize_result 计入解析，逐条格式化和结束时的保存计入保存
+CPU_STAGES = {
+    "prompt_building": ["_build_raw_messages", "_build_guidance_messages", "_build_long_term_messages"],
+    "parsing": ["_postprocess_response", "_extract_vote_label", "_finalize_result"],
+    "saving": ["ResultWriter._format", "ResultWriter._save"],
+}
+
+
+class MockClient:
+    """
+    与 OpenAI 客户端接口相同的进程内模拟客户端，回答由 fake_llm_server.make_answer 生成。
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, n=1, **kwargs):
+        from fake_llm_server import make_answer
+        with self._lock:
+            self.calls += 1
+            sample_start = self.calls
+        if self.latency:
+            time.sleep(self.latency)
+        choices = []
+        for i in range(n or 1):
+            answer, reasoning = make_answer(model, messages, sample_start + i)
+            content = f"<think>\n{reasoning}\n</think>\n\n{answer}" if reasoning else answer
+            choices.append(types.SimpleNamespace(index=i, message=types.SimpleNamespace(content=content),
+                                                 finish_reason="stop"))
+        usage = types.SimpleNamespace(prompt_tokens=0, completion_tokens=0, total_tokens=0)
+        return types.SimpleNamespace(choices=choices, usage=usage)
+
+
+def make_dataset(n):
+    """
+    生成 n 个合成问题，格式与 CommonSense.json 相同。
+    """
+    return [{
+        "id": f"bench{i:06d}",
+        "question": f"Benchmark question {i}?",
+        "choices": [{"label": label, "text": f"option {label} for question {i}"} for label in "ABCDE"],
+        "answerKey": "ABCDE"[i % 5],
+    } for i in range(n)]
+
+
+def percentile(values, q):
+    """
+    线性插值的分位数，values 为空时返回 None。
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def _instrument(pipeline, cpu_seconds, latencies, lock):
+    """
+    包装 pipeline 中的函数：按阶段累计 CPU 时间 (thread_time)，并记录每个问题的端到端延迟。
+    """
+    for stage, names in CPU_STAGES.items():
+        for name in names:
+            owner_name, _, attr = name.rpartition(".")
+            owner = getattr(pipeline, owner_name) if owner_name else pipeline
+            original = getattr(owner, attr)
+
+            @functools.wraps(original)
+            def timed(*args, _original=original, _stage=stage, **kwargs):
+                start = time.thread_time()
+                try:
+                    return _original(*args, **kwargs)
+                finally:
+                    elapsed = time.thread_time() - start
+                    with lock:
+                        cpu_seconds[_stage] += elapsed
+
+            setattr(owner, attr, timed)
+
+    original_worker = pipeline.worker_run_protocol
+
+    @functools.wraps(original_worker)
+    def timed_worker(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original_worker(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    pipeline.worker_run_protocol = timed_worker
+    return original_worker
+
+
+def run_case(size, method, config):
+    """
+    在当前进程中运行一个基准用例，应在单独的子进程中调用。
+    Args:
+        size (int): 问题数。
+        method (str): 缓解方法。
+        config (dict): num_workers、mock_latency、worker_sample 设置（子进程中不会继承父进程修改过的全局变量）。
+    Returns:
+        dict: 该用例的测量结果。
+    """
+    os.environ.setdefault("serverless_api", "benchmark")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    workdir = tempfile.mkdtemp(prefix="conformity_bench_")  # 结果文件写到临时目录，不覆盖 output/
+    os.chdir(workdir)
+    with open("CommonSense.json", "w", encoding="utf-8") as f:
+        json.dump(make_dataset(size), f)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        import pipeline
+        pipeline.method = method
+        pipeline.cache_mode = "off"
+        mock = MockClient(config["mock_latency"])
+        pipeline.client = mock
+        pipeline._init_runtime()  # 使用模拟客户端，其余运行时对象按上面的配置创建
+
+        cpu_seconds = {stage: 0.0 for stage in CPU_STAGES}
+        latencies = []
+        lock = threading.Lock()
+        original_worker = _instrument(pipeline, cpu_seconds, latencies, lock)
+
+        # 单线程直接调用 worker_run_protocol，测量单个问题的开销
+        qa_dataset = pipeline.load_data("CommonSense.json", size)
+        worker_seconds = {}
+        for protocol_type in pipeline._protocols_to_run():
+            items = qa_dataset[:config["worker_sample"]]
+            start = time.perf_counter()
+            for qa_item in items:
+                original_worker(qa_item, protocol_type, "bench-model", qa_dataset)
+            worker_seconds[protocol_type] = (time.perf_counter() - start) / max(len(items), 1)
+
+        mock.calls = 0
+        for stage in cpu_seconds:
+            cpu_seconds[stage] = 0.0
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        pipeline.main_experiment("CommonSense.json", "bench-model", data_length=size,
+                                 num_workers=config["num_workers"])
+        wall = time.perf_counter() - start
+        cpu_total = time.process_time() - cpu_start
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "size": size,
+        "method": method,
+        "requests": mock.calls,
+        "wall_seconds": wall,
+        "requests_per_second": mock.calls / wall if wall else None,
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "cpu_seconds": dict(cpu_seconds, total=cpu_total),
+        "worker_seconds_per_question": worker_seconds,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # Linux 上单位为 KB
+    }
+
+
+def _case_name(result):
+    return f"{result['size']}{result['method'] or '-none'}"
+
+
+def compare_results(results, baseline):
+    """
+    与基准结果逐项比较，返回退化项列表。
+    """
+    baseline_cases = {_case_name(r): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        name = _case_name(result)
+        base = baseline_cases.get(name)
+        if base is None:
+            print(f"{name}: 基准中没有该用例")
+            continue
+        checks = [("requests_per_second", result["requests_per_second"], base["requests_per_second"], True),
+                  ("latency_p95", result["latency_p95"], base["latency_p95"], False),
+                  ("peak_rss_mb", result["peak_rss_mb"], base["peak_rss_mb"], False)]
+        checks += [(f"cpu_{stage}", result["cpu_seconds"][stage], base["cpu_seconds"].get(stage), False)
+                   for stage in CPU_STAGES]
+        for metric, value, base_value, higher_is_better in checks:
+            if not base_value:
+                continue
+            if not value:
+                # 基准中有耗时而本次为 0，多半是统计的函数已不再被调用，需要更新 CPU_STAGES
+                print(f"{name:>24} {metric:>20}: {base_value:10.4f} -> {'未测到':>10}  <-- 退化")
+                regressions.append((name, metric, None))
+                continue
+            change = value / base_value - 1
+            worse = -change if higher_is_better else change
+            flag = "  <-- 退化" if worse > regression_threshold else ""
+            print(f"{name:>24} {metric:>20}: {base_value:10.4f} -> {value:10.4f} ({change:+.1%}){flag}")
+            if flag:
+                regressions.append((name, metric, change))
+    return regressions
+
+
+def main():
+    config = {"num_workers": num_workers, "mock_latency": mock_latency, "worker_sample": worker_sample}
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for size in sizes:
+        for method in methods:
+            with ctx.Pool(1) as pool:
+                result = pool.apply(run_case, (size, method, config))
+            results.append(result)
+            print(f"{_case_name(result):>24}: {result['requests_per_second']:.1f} req/s, "
+                  f"p50/p95/p99 = {result['latency_p50']:.4f}/{result['latency_p95']:.4f}/"
+                  f"{result['latency_p99']:.4f} s, 峰值内存 {result['peak_rss_mb']:.1f} MB")
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": config,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+    print(f"基准结果已保存为 {output_file}")
+
+    if compare and os.path.exists(baseline_file):
+        with open(baseline_file, "r", encoding="utf-8") as f:
+            regressions = compare_results(results, json.load(f))
+        print(f"共 {len(regressions)} 项退化。" if regressions else "没有发现退化。")
+    if update_baseline:
+        with open(baseline_file, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
+        print(f"已更新基准 {baseline_file}")
+
+
+if __name__ == "__main__":
+    main()
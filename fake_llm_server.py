@@ -0,0 +1,398 @@
+import collections
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 本地 OpenAI 兼容的模拟服务，用于在没有网络的情况下对 pipeline.py / run_llm.py 做压测。
+# 使用方法：运行 python fake_llm_server.py，再设置环境变量
+#   serverless_url=http://127.0.0.1:8000/v1 serverless_api=fake
+# 后照常运行 pipeline.py 或 run_llm.py。
+
+host = "127.0.0.1"
+port = 8000
+latency = "lognormal"  # 延迟分布："fixed"、"uniform"、"exponential"、"lognormal"
+latency_mean = 0.8  # 平均延迟（秒）
+latency_sigma = 0.5  # lognormal 的对数标准差；uniform 时为相对半宽
+error_rate = 0.01  # 返回 500 / 503 的概率
+rate_limit_rate = 0.02  # 返回 429 的概率
+retry_after = 1.0  # 429 响应中 retry-after 头的秒数
+conformity_bias = 0.6  # 提示中有其他人的意见时跟随多数意见的概率
+think_models = ("DeepSeek-R1",)  # 名称包含这些字符串的模型在回答前输出 <think> 推理块
+think_chars = 600  # <think> 推理块的平均字符数
+explanation_chars = 0  # 答案后面附加的解释的平均字符数，模拟在给出选项后继续输出的模型
+stream_chunk_chars = 4  # 流式响应每个数据块的字符数（约一个 token）
+token_interval = 0.0  # 生成每个数据块的时间（秒），模拟逐 token 生成；非流式响应在 latency 之后等待全部生成完
+reasoning_content_field = False  # 为 True 时流式响应把推理放在 delta.reasoning_content 中，而不是 <think> 块
+label_mass = 0.95  # logprobs 请求中选项标签 token 所占的平均总概率，其余分给 "The"、"You" 等非标签 token
+seed = 0
+
+_THINK_SENTENCES = [
+    "Let me look at each option carefully.",
+    "The question asks for the most common-sense choice.",
+    "Other players have shared their opinions, but I should check them.",
+    "Option {label} seems to fit the question best.",
+    "I will consider the alternatives once more before answering.",
+]
+
+_EXPLANATION_SENTENCES = [
+    "This option matches the situation described in the question.",
+    "The other options do not fit as naturally.",
+    "It is the most common-sense interpretation.",
+]
+
+_OTHER_TOKENS = ["The", "You", "(", "I", "Answer"]
+
+_CHOICE_PATTERN = re.compile(r'^\(([A-Z])\) ?(.*)$')
+_OPINION_PATTERN = re.compile(r'^[^:\n]+: .*?\(([A-Z])\)')
+
+
+def _estimate_tokens(text):
+    """
+    粗略估计 token 数：约 4 个字符一个 token。
+    """
+    return max(1, len(text) // 4)
+
+
+def parse_prompt(messages):
+    """
+    从提示中解析当前问题的选项和其他人的意见。
+    只看最后一条用户消息中最后一个 "Answer choices:" 之后的内容，长期协议中的历史问答不会被计入。
+    Returns:
+        tuple: (选项列表 [(标签, 内容)], 其他人意见中出现的标签列表)。
+    """
+    content = ""
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            content = message.get("content") or ""
+            break
+    start = content.rfind("Answer choices:")
+    if start < 0:
+        return [], []
+    lines = content[start + len("Answer choices:"):].strip().split("\n")
+
+    choices, opinions = [], []
+    for line in lines:
+        line = line.strip()
+        match = _CHOICE_PATTERN.match(line)
+        if match and not opinions:
+            choices.append((match.group(1), match.group(2)))
+            continue
+        match = _OPINION_PATTERN.match(line)
+        if match and not line.startswith("You:") and match.group(1) in dict(choices):
+            opinions.append(match.group(1))
+    return choices, opinions
+
+
+def _sample_latency(rng):
+    if latency == "fixed":
+        return latency_mean
+    if latency == "uniform":
+        return rng.uniform(latency_mean * (1 - latency_sigma), latency_mean * (1 + latency_sigma))
+    if latency == "exponential":
+        return rng.expovariate(1 / latency_mean)
+    # lognormal：调整 mu 使均值等于 latency_mean
+    return rng.lognormvariate(math.log(latency_mean) - latency_sigma ** 2 / 2, latency_sigma)
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """
+    多线程的模拟服务。回答由 (模型, 消息, 第几次收到相同请求) 决定，
+    因此同一组请求无论以什么顺序到达，得到的回答集合都相同。
+    """
+    daemon_threads = True
+    request_queue_size = 1024  # 默认的 5 在高并发压测时会导致连接被拒绝
+
+    def __init__(self, address=None):
+        super().__init__(address or (host, port), _Handler)
+        self._lock = threading.Lock()
+        self._seen = collections.Counter()  # 请求键 -> 已收到的次数
+        self._fault_random = random.Random(seed)  # 错误注入和延迟使用的随机数，与回答无关
+        self.stats = collections.Counter()
+
+    def next_sample(self, key, n):
+        """
+        返回本次请求的样本序号起点，并为相同请求预留 n 个样本。
+        """
+        with self._lock:
+            start = self._seen[key]
+            self._seen[key] += n
+            return start
+
+    def roll(self):
+        """
+        决定本次请求的结果："ok"、"rate_limit" 或 "error"，并给出模拟的延迟。
+        """
+        with self._lock:
+            r = self._fault_random.random()
+            delay = _sample_latency(self._fault_random)
+            if r < rate_limit_rate:
+                outcome = "rate_limit"
+            elif r < rate_limit_rate + error_rate:
+                outcome = "error"
+            else:
+                outcome = "ok"
+            self.stats[outcome] += 1
+        return outcome, delay
+
+
+def make_answer(model_name, messages, sample_index):
+    """
+    生成一个确定性的回答。
+    Args:
+        model_name (str): 模型名称。
+        messages (list): 聊天消息列表。
+        sample_index (int): 相同请求的第几个样本。
+    Returns:
+        tuple: (回答内容, 推理内容或 "")。
+    """
+    payload = json.dumps([model_name, messages, sample_index, seed], ensure_ascii=False, sort_keys=True)
+    rng = random.Random(hashlib.sha256(payload.encode("utf-8")).digest())
+
+    choices, opinions = parse_prompt(messages)
+    if not choices:
+        choices = [("A", "")]
+    if opinions and rng.random() < conformity_bias:
+        label = collections.Counter(opinions).most_common(1)[0][0]
+    else:
+        label = rng.choice(choices)[0]
+    text = dict(choices).get(label, "")
+    answer = f'You: The best answer is: "({label}) {text}"'
+    if explanation_chars:
+        sentences = []
+        target = rng.uniform(0.5, 1.5) * explanation_chars
+        while sum(len(s) + 1 for s in sentences) < target:
+            sentences.append(rng.choice(_EXPLANATION_SENTENCES))
+        answer += " " + " ".join(sentences)
+
+    reasoning = ""
+    if any(name in model_name for name in think_models):
+        sentences = []
+        target = rng.uniform(0.5, 1.5) * think_chars
+        while sum(len(s) + 1 for s in sentences) < target:
+            sentences.append(rng.choice(_THINK_SENTENCES).format(label=label))
+        reasoning = " ".join(sentences)
+    return answer, reasoning
+
+
+def make_label_logprobs(model_name, messages):
+    """
+    生成第一个 token 的确定性概率分布，模拟只要求输出选项标签的 logprobs 请求：
+    各选项有随机的基础权重，提示中有其他人的意见时把 conformity_bias 比例的概率移给多数意见；
+    每个标签的概率有一部分分给带前导空格的写法（" A"），剩余概率分给几个非标签 token。
+    Args:
+        model_name (str): 模型名称。
+        messages (list): 聊天消息列表。
+    Returns:
+        list: 按概率从大到小排列的 [(token, logprob)]，第一项即贪心解码生成的 token。
+    """
+    payload = json.dumps([model_name, messages, "logprobs", seed], ensure_ascii=False, sort_keys=True)
+    rng = random.Random(hashlib.sha256(payload.encode("utf-8")).digest())
+
+    choices, opinions = parse_prompt(messages)
+    labels = [label for label, _ in choices] or ["A"]
+    weights = [rng.random() ** 3 + 1e-6 for _ in labels]
+    probs = {label: w / sum(weights) for label, w in zip(labels, weights)}
+    if opinions:
+        majority = collections.Counter(opinions).most_common(1)[0][0]
+        probs = {label: (1 - conformity_bias) * p + (conformity_bias if label == majority else 0.0)
+                 for label, p in probs.items()}
+
+    mass = rng.uniform(2 * label_mass - 1, 1.0) if label_mass < 1 else 1.0
+    tokens = []
+    for label, p in probs.items():
+        tokens.append((label, p * mass * 0.9))
+        tokens.append((" " + label, p * mass * 0.1))
+    tokens.extend((token, (1 - mass) / len(_OTHER_TOKENS)) for token in _OTHER_TOKENS)
+    tokens.sort(key=lambda t: -t[1])
+    return [(token, math.log(max(p, 1e-12))) for token, p in tokens]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, data):
+        # HTTP/1.1 分块传输编码
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_event(self, payload):
+        self._write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+    def _send_stream(self, response_id, model_name, samples, usage):
+        """
+        以 Server-Sent Events 逐块发送回答，格式与 OpenAI 的流式响应相同。客户端提前断开时停止发送。
+        Args:
+            samples (list): [(回答内容, 推理内容)]，每项对应一个 choice。
+            usage (dict or None): 不为 None 时在最后一个数据块中返回。
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(index, delta, finish_reason=None):
+            return {"id": response_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": model_name, "choices": [{"index": index, "delta": delta, "finish_reason": finish_reason}]}
+
+        try:
+            for index, (answer, reasoning) in enumerate(samples):
+                self._send_event(event(index, {"role": "assistant", "content": ""}))
+                if reasoning and reasoning_content_field:
+                    pieces = [("reasoning_content", reasoning), ("content", answer)]
+                elif reasoning:
+                    pieces = [("content", f"<think>\n{reasoning}\n</think>\n\n{answer}")]
+                else:
+                    pieces = [("content", answer)]
+                for field, text in pieces:
+                    for i in range(0, len(text), stream_chunk_chars):
+                        if token_interval:
+                            time.sleep(token_interval)
+                        self._send_event(event(index, {field: text[i:i + stream_chunk_chars]}))
+                self._send_event(event(index, {}, "stop"))
+            if usage is not None:
+                self._send_event({"id": response_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                                  "model": model_name, "choices": [], "usage": usage})
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            with self.server._lock:
+                self.server.stats["stream_aborted"] += 1
+
+    def _send_logprobs(self, response_id, model_name, messages, n, top_logprobs):
+        """
+        返回一个 token 的回答及其 top_logprobs（贪心解码，n 个样本相同）。不支持流式。
+        """
+        tokens = make_label_logprobs(model_name, messages)
+        token, logprob = tokens[0]
+        entry = {
+            "token": token,
+            "logprob": logprob,
+            "bytes": list(token.encode("utf-8")),
+            "top_logprobs": [{"token": t, "logprob": lp, "bytes": list(t.encode("utf-8"))} for t, lp in tokens[:top_logprobs]],
+        }
+        choices = [{"index": i, "message": {"role": "assistant", "content": token},
+                    "logprobs": {"content": [entry]}, "finish_reason": "length"} for i in range(n)]
+        prompt_tokens = _estimate_tokens("".join(m.get("content") or "" for m in messages))
+        self._send_json(200, {
+            "id": response_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model_name,
+            "choices": choices,
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": n, "total_tokens": prompt_tokens + n},
+        })
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": []})
+        else:
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._send_json(400, {"error": {"message": "invalid json", "type": "invalid_request_error"}})
+            return
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+
+        server = self.server
+        outcome, delay = server.roll()
+        time.sleep(delay)
+        if outcome == "rate_limit":
+            self._send_json(429, {"error": {"message": "rate limit exceeded", "type": "rate_limit_error"}},
+                            {"retry-after": str(retry_after)})
+            return
+        if outcome == "error":
+            self._send_json(503, {"error": {"message": "server overloaded", "type": "server_error"}})
+            return
+
+        model_name = body.get("model", "")
+        messages = body.get("messages", [])
+        n = body.get("n") or 1
+        key = hashlib.sha256(json.dumps([model_name, messages], ensure_ascii=False, sort_keys=True)
+                             .encode("utf-8")).hexdigest()
+        start = server.next_sample(key, n)
+
+        response_id = f"chatcmpl-{key[:12]}-{start}"
+        if body.get("logprobs"):
+            self._send_logprobs(response_id, model_name, messages, n, body.get("top_logprobs") or 0)
+            return
+
+        samples = [make_answer(model_name, messages, start + i) for i in range(n)]
+        choices, completion_tokens, reasoning_tokens = [], 0, 0
+        for i, (answer, reasoning) in enumerate(samples):
+            content = f"<think>\n{reasoning}\n</think>\n\n{answer}" if reasoning else answer
+            completion_tokens += _estimate_tokens(content)
+            reasoning_tokens += _estimate_tokens(reasoning) if reasoning else 0
+            choices.append({"index": i, "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop"})
+
+        prompt_tokens = _estimate_tokens("".join(m.get("content") or "" for m in messages))
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "completion_tokens_details": {"reasoning_tokens": reasoning_tokens},
+        }
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            self._send_stream(response_id, model_name, samples, usage if include_usage else None)
+            return
+        if token_interval:
+            # 非流式响应要等全部内容生成完才返回
+            time.sleep(token_interval * sum(math.ceil(len(c["message"]["content"]) / stream_chunk_chars)
+                                            for c in choices))
+        self._send_json(200, {
+            "id": response_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model_name,
+            "choices": choices,
+            "usage": usage,
+        })
+
+
+def start_server(address=None):
+    """
+    在后台线程中启动模拟服务，address 的端口为 0 时自动选择空闲端口。
+    Returns:
+        FakeLLMServer: 已启动的服务，base_url 为 f"http://{host}:{server.server_port}/v1"，用完后调用 shutdown()。
+    """
+    server = FakeLLMServer(address)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    server = FakeLLMServer()
+    print(f"模拟服务已启动：http://{host}:{server.server_port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"请求统计：{dict(server.stats)}")
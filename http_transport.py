@@ -0,0 +1,161 @@
+import threading
+import time
+
+import httpx
+from openai import DefaultAsyncHttpxClient, DefaultHttpxClient
+
+try:
+    import h2  # noqa: F401  HTTP/2 为可选依赖：pip install httpx[http2]
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class ConnectionStats:
+    """
+    HTTP 连接的统计：通过 httpcore 的 trace 扩展记录每个请求是新建连接（TCP 连接、TLS 握手）还是复用了连接池中的连接，
+    以及使用的 HTTP 版本。同步和异步客户端可以共用一个实例，线程安全。
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.tls_handshakes = 0
+        self.connect_seconds = 0.0
+        self.tls_seconds = 0.0
+        self.http2_requests = 0
+        self._lock = threading.Lock()
+
+    def _trace(self):
+        """
+        为单个请求创建 trace 回调，连接建立和 TLS 握手的事件都发生在发送请求头之前。
+        """
+        state = {"new": False, "started": {}}
+
+        def trace(event_name, info):
+            name, _, phase = event_name.rpartition(".")
+            if phase == "started":
+                state["started"][name] = time.perf_counter()
+                return
+            if phase != "complete":
+                return
+            elapsed = time.perf_counter() - state["started"].pop(name, time.perf_counter())
+            if name == "connection.connect_tcp":
+                state["new"] = True
+                with self._lock:
+                    self.new_connections += 1
+                    self.connect_seconds += elapsed
+            elif name == "connection.start_tls":
+                with self._lock:
+                    self.tls_handshakes += 1
+                    self.tls_seconds += elapsed
+            elif name.endswith(".send_request_headers"):
+                with self._lock:
+                    self.requests += 1
+                    self.reused_connections += not state["new"]
+                    self.http2_requests += name.startswith("http2.")
+
+        return trace
+
+    def _async_trace(self):
+        trace = self._trace()
+
+        async def async_trace(event_name, info):
+            trace(event_name, info)
+
+        return async_trace
+
+    def event_hooks(self):
+        """
+        httpx.Client 的 event_hooks：为每个请求挂上 trace 回调。
+        """
+        def on_request(request):
+            request.extensions["trace"] = self._trace()
+
+        return {"request": [on_request], "response": []}
+
+    def async_event_hooks(self):
+        """
+        httpx.AsyncClient 的 event_hooks，trace 回调需要是协程函数。
+        """
+        async def on_request(request):
+            request.extensions["trace"] = self._async_trace()
+
+        return {"request": [on_request], "response": []}
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": self.reused_connections,
+                "tls_handshakes": self.tls_handshakes,
+                "connect_seconds": self.connect_seconds,
+                "tls_seconds": self.tls_seconds,
+                "http2_requests": self.http2_requests,
+            }
+
+    def report(self):
+        """
+        返回连接统计的文字描述。
+        """
+        data = self.snapshot()
+        if data["requests"] == 0:
+            return "HTTP 连接：没有发送任何请求"
+        text = (f"HTTP 连接：请求 {data['requests']} 次，新建连接 {data['new_connections']} 次，"
+                f"复用连接 {data['reused_connections']} 次 (复用率 {data['reused_connections'] / data['requests']:.2%})，"
+                f"TLS 握手 {data['tls_handshakes']} 次")
+        if data["new_connections"]:
+            text += f"，平均建立连接 {data['connect_seconds'] / data['new_connections'] * 1000:.1f} ms"
+        if data["tls_handshakes"]:
+            text += f"，平均 TLS 握手 {data['tls_seconds'] / data['tls_handshakes'] * 1000:.1f} ms"
+        if data["http2_requests"]:
+            text += f"，其中 HTTP/2 请求 {data['http2_requests']} 次"
+        return text
+
+
+def _merge_hooks(*hook_sets):
+    merged = {"request": [], "response": []}
+    for hooks in hook_sets:
+        for kind, functions in (hooks or {}).items():
+            merged[kind].extend(functions)
+    return merged
+
+
+def build_http_client(max_connections=1000, max_keepalive=100, keepalive_expiry=30.0, http2=False,
+                      connect_timeout=10.0, read_timeout=600.0, write_timeout=30.0, pool_timeout=30.0,
+                      accept_encoding=None, event_hooks=None, stats=None, is_async=False):
+    """
+    构造传给 OpenAI / AsyncOpenAI 的 httpx 客户端，连接池、keep-alive、HTTP/2、超时和响应压缩都可以配置。
+    OpenAI 客户端会用自己的 timeout 覆盖 httpx 的超时设置，创建时需要同时传入 timeout=http_client.timeout。
+    Args:
+        max_connections (int): 连接池的最大连接数，应不小于同时在途的请求数。
+        max_keepalive (int): 空闲时保留的最大 keep-alive 连接数。
+        keepalive_expiry (float): 空闲 keep-alive 连接的保留时间（秒）。
+        http2 (bool): 是否启用 HTTP/2 多路复用；未安装 h2 时给出警告并使用 HTTP/1.1。
+        connect_timeout (float): 建立连接（含 TLS 握手）的超时（秒）。
+        read_timeout (float): 等待响应数据的超时（秒）。
+        write_timeout (float): 发送请求的超时（秒）。
+        pool_timeout (float): 等待连接池空闲连接的超时（秒）。
+        accept_encoding (str): Accept-Encoding 请求头，None 时使用 httpx 的默认值，"identity" 表示不压缩。
+        event_hooks (dict): 其他 event_hooks（如请求遥测），与连接统计的 hooks 合并。
+        stats (ConnectionStats): 连接统计，为 None 时不统计。
+        is_async (bool): 为 True 时构造 httpx.AsyncClient。
+    Returns:
+        httpx.Client 或 httpx.AsyncClient。
+    """
+    if http2 and not HTTP2_AVAILABLE:
+        print("警告：未安装 h2，无法使用 HTTP/2，改用 HTTP/1.1（pip install httpx[http2]）")
+        http2 = False
+    if stats is not None:
+        event_hooks = _merge_hooks(event_hooks, stats.async_event_hooks() if is_async else stats.event_hooks())
+    client_class = DefaultAsyncHttpxClient if is_async else DefaultHttpxClient
+    return client_class(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive,
+                            keepalive_expiry=keepalive_expiry),
+        timeout=httpx.Timeout(connect=connect_timeout, read=read_timeout, write=write_timeout, pool=pool_timeout),
+        http2=http2,
+        headers={"Accept-Encoding": accept_encoding} if accept_encoding else None,
+        event_hooks=event_hooks,
+    )
@@ -1,17 +1,14 @@
 import json
-import re
 import os
 
+from answer_extraction import default_extractor, extract_label
+
+
 def extract_model_ans(protocol_result):
     """
-    更宽松地从 protocol_result 中提取模型答案的 label
+    从 protocol_result 中提取模型答案的 label，与 pipeline 使用同一套规则（answer_extraction）。
     """
-    if not isinstance(protocol_result, str):
-        return ""
-    match = re.search(r'[\("]?([A-E])[\)\.][ ]', protocol_result)
-    if match:
-        return match.group(1)
-    return ""
+    return extract_label(protocol_result)
 
 def process_json_file(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
@@ -41,3 +38,4 @@ if __name__ == "__main__":
             if filename.endswith(".json"):
                 filepath = os.path.join(subdir, filename)
                 process_json_file(filepath)
+    print(default_extractor.report())
@@ -0,0 +1,69 @@
+import gzip
+import json
+import os
+
+
+def write_prompt_table(path, rows, fingerprint=None):
+    """
+    把预编译的提示逐行写入 gzip 压缩的 JSONL 提示表。先写临时文件再替换，写入中断不会留下残缺的表。
+    Args:
+        path (str): 提示表路径（.jsonl.gz）。
+        rows (iterable): 每行一个字典，包含 id、protocol、method、messages。
+        fingerprint (dict): 生成这些提示的输入（数据集、随机种子、提示版本等），作为第一行写入，
+            之后用 read_fingerprint 判断提示表是否仍然有效。
+    Returns:
+        int: 写入的提示行数，不含指纹行。
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    count = 0
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        if fingerprint is not None:
+            f.write(json.dumps({"fingerprint": fingerprint}, ensure_ascii=False, separators=(",", ":")) + "\n")
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n")
+            count += 1
+    os.replace(tmp_path, path)
+    return count
+
+
+def iter_prompt_table(path, protocol_type=None):
+    """
+    逐行读取提示表，不会一次性载入整个文件。
+    Args:
+        path (str): 提示表路径。
+        protocol_type (str): 只返回该协议的行，为 None 时返回全部。
+    Yields:
+        dict: 提示表中的一行。
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            row = json.loads(line)
+            if "fingerprint" in row:
+                continue
+            if protocol_type is None or row["protocol"] == protocol_type:
+                yield row
+
+
+def read_fingerprint(path):
+    """
+    读取提示表第一行的指纹。
+    Returns:
+        dict: 写入时的指纹；没有指纹（旧版本的提示表）或文件无法读取时为 None。
+    """
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            row = json.loads(f.readline() or "null")
+    except (OSError, EOFError, ValueError):
+        return None
+    return row.get("fingerprint") if isinstance(row, dict) else None
+
+
+def load_prompt_table(path, protocol_type):
+    """
+    读取某个协议的全部提示。
+    Returns:
+        dict: id -> messages，构造失败（messages 为 null）的行不包含在内。
+    """
+    return {row["id"]: row["messages"] for row in iter_prompt_table(path, protocol_type)
+            if row["messages"] is not None}
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+
+class ResponseCache:
+    """
+    基于内容哈希的磁盘响应缓存，放在 my_request 之前。
+    - 键为 (模型名称, 消息, max_tokens, temperature, top_p, top_k, 样本序号) 的 SHA-256；
+      自一致性的每次投票使用不同的样本序号，分别缓存，保证投票之间相互独立。
+    - 每个条目是一个独立文件，先写临时文件再 os.replace，多线程、多进程同时写入都是安全的。
+    - 缓存总大小超过 max_bytes 时按最近访问时间淘汰最旧的条目。
+    - read_only=True 为只读回放模式：只从缓存读取，不写入也不淘汰。
+    """
+
+    def __init__(self, cache_dir="cache", max_bytes=2 * 1024 ** 3, read_only=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._size = None  # 当前缓存总字节数，首次写入时统计
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_name, messages, max_tokens, temperature, top_p, top_k, sample_index=0, extra=None):
+        """
+        计算请求的缓存键。
+        Args:
+            model_name (str): 模型名称。
+            messages (list): 聊天消息列表。
+            max_tokens (int): 最大生成长度。
+            temperature (float): 采样温度。
+            top_p (float): top_p 采样参数。
+            top_k (int): top_k 采样参数。
+            sample_index (int): 同一请求的第几个样本（自一致性投票序号）。
+            extra (dict): 其他影响响应的请求参数（如 logprobs 设置），为 None 时不计入，已有的缓存键不变。
+        Returns:
+            str: 十六进制的 SHA-256 摘要。
+        """
+        fields = {
+            "model": model_name,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "top_k": top_k,
+            "sample_index": sample_index,
+        }
+        if extra is not None:
+            fields["extra"] = extra
+        payload = json.dumps(fields, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key):
+        """
+        读取缓存的响应内容。
+        Returns:
+            str: 缓存的响应内容，未命中时为 None。
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                response = json.load(f)["response"]
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        if not self.read_only:
+            try:
+                os.utime(path)  # 更新访问时间，供淘汰时参考
+            except OSError:
+                pass
+        with self._lock:
+            self.hits += 1
+        return response
+
+    def put(self, key, response):
+        """
+        写入一条响应。只读模式或响应为空时不写入。
+        """
+        if self.read_only or response is None:
+            return
+
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        data = json.dumps({"response": response}, ensure_ascii=False).encode("utf-8")
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self.writes += 1
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data)
+            need_evict = self._size > self.max_bytes
+        if need_evict:
+            self._evict()
+
+    def _list_entries(self):
+        entries = []
+        for subdir, _, files in os.walk(self.cache_dir):
+            for filename in files:
+                if not filename.endswith(".json"):
+                    continue
+                path = os.path.join(subdir, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # 可能已被其他进程淘汰
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._list_entries())
+
+    def _evict(self):
+        """
+        按最近访问时间从旧到新删除条目，直到总大小降到上限的 90%。
+        """
+        if not self._evict_lock.acquire(blocking=False):
+            return  # 已有线程在淘汰
+        try:
+            entries = sorted(self._list_entries())
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * 0.9
+            removed = 0
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            with self._lock:
+                self._size = total
+                self.evictions += removed
+        finally:
+            self._evict_lock.release()
+
+    def report(self):
+        """
+        返回缓存命中统计的文字描述。
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            hit_rate = (self.hits / total * 100) if total else 0.0
+            return (f"响应缓存：命中 {self.hits} 次，未命中 {self.misses} 次 (命中率 {hit_rate:.2f}%)，"
+                    f"写入 {self.writes} 条，淘汰 {self.evictions} 条")
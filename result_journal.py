@@ -0,0 +1,86 @@
+import json
+import os
+import threading
+import time
+
+
+class ResultJournal:
+    """
+    追加写入的 JSONL 结果日志，每完成一个问题就写入一行，进程崩溃或中断时已完成的结果不会丢失。
+    每写入 fsync_every 行或距上次同步超过 fsync_interval 秒时调用一次 fsync。
+    """
+
+    def __init__(self, path, truncate=False, fsync_every=50, fsync_interval=5.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        needs_newline = False
+        if not truncate and os.path.exists(path) and os.path.getsize(path) > 0:
+            # 上次写入可能在行中间中断，补一个换行，避免新记录接在残缺行后面
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        self._file = open(path, "w" if truncate else "a", encoding="utf-8")
+        if needs_newline:
+            self._file.write("\n")
+
+    def append(self, entry):
+        """
+        追加一条结果记录。线程安全。
+        """
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.flush()
+            self._sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def load_journal(path):
+    """
+    读取结果日志，同一个 id 出现多次时以最后一条为准；无法解析的残缺行会被跳过。
+    Args:
+        path (str): 日志文件路径。
+    Returns:
+        dict: id -> 结果记录，文件不存在时为空字典。
+    """
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(entry, dict) and "id" in entry:
+                entries[entry["id"]] = entry
+    return entries
@@ -0,0 +1,303 @@
+import glob
+import json
+import os
+import queue
+import re
+import threading
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow 为可选依赖，只有使用列式存储时才需要
+    pa = ds = pq = None
+
+# 问题表：每个数据集只写一次
+QUESTION_SCHEMA = None if pa is None else pa.schema([
+    ("id", pa.string()),
+    ("question", pa.string()),
+    ("choices", pa.list_(pa.struct([("label", pa.string()), ("text", pa.string())]))),
+    ("answerKey", pa.string()),
+])
+
+# 结果表：按 model / length / method / protocol 分区，每行只保存与问题无关的字段
+RESULT_SCHEMA = None if pa is None else pa.schema([
+    ("id", pa.string()),
+    ("protocol_result", pa.string()),
+    ("model_ans", pa.string()),
+    ("vote_labels", pa.list_(pa.string())),
+    ("votes_used", pa.int32()),
+    ("label_probs", pa.map_(pa.string(), pa.float64())),  # logprobs 评分的选项概率
+    ("label_mass", pa.float64()),
+])
+
+# 分区列；读取时显式给出完整的表结构，旧分区中没有的列读出为 null
+PARTITION_SCHEMA = None if pa is None else pa.schema([
+    ("model", pa.string()),
+    ("length", pa.int32()),
+    ("method", pa.string()),
+    ("protocol", pa.string()),
+])
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("列式结果存储需要 pyarrow，请先运行 pip install pyarrow")
+
+
+def _write_table(table, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(table, path + ".tmp", compression="zstd")
+    os.replace(path + ".tmp", path)
+
+
+class ResultStore:
+    """
+    规范化的列式结果存储（Parquet）：
+    - store/questions/{dataset}.parquet：问题、选项和正确答案，每个数据集一份；
+    - store/results/model=.../length=.../method=.../protocol=.../part-0.parquet：每个 (模型, 条目数, 方法, 协议)
+      一个分区（对应原来的一个结果文件），只保存 id、原始回答、提取的选项和投票明细；
+    读取时只加载需要的列和分区。q_content 不再保存，需要时可以从提示表重新得到。
+    """
+
+    def __init__(self, root="store"):
+        self.root = root
+
+    def _questions_path(self, dataset):
+        return os.path.join(self.root, "questions", f"{dataset}.parquet")
+
+    def _results_dir(self):
+        return os.path.join(self.root, "results")
+
+    def _partition_path(self, model_name, length, method, protocol_type):
+        return os.path.join(self._results_dir(), f"model={model_name}", f"length={length}",
+                            f"method={method or 'none'}", f"protocol={protocol_type}", "part-0.parquet")
+
+    def write_questions(self, qa_dataset, dataset="CommonSense"):
+        """
+        写入问题表。表已存在时只追加其中没有的问题。
+        Returns:
+            int: 新写入的问题数。
+        """
+        _require_pyarrow()
+        path = self._questions_path(dataset)
+        existing = []
+        if os.path.exists(path):
+            existing = pq.read_table(path).to_pylist()
+        known = {row["id"] for row in existing}
+        new_rows = []
+        for qa_item in qa_dataset:
+            if qa_item["id"] in known:
+                continue
+            known.add(qa_item["id"])
+            new_rows.append({
+                "id": qa_item["id"],
+                "question": qa_item["question"],
+                "choices": [{"label": c["label"], "text": c["text"]} for c in qa_item["choices"]],
+                "answerKey": qa_item["answerKey"],
+            })
+        if new_rows:
+            _write_table(pa.Table.from_pylist(existing + new_rows, schema=QUESTION_SCHEMA), path)
+        return len(new_rows)
+
+    def read_questions(self, dataset="CommonSense", columns=None):
+        """
+        Returns:
+            pyarrow.Table: 问题表中指定的列。
+        """
+        _require_pyarrow()
+        return pq.read_table(self._questions_path(dataset), columns=columns)
+
+    def write_results(self, model_name, method, protocol_type, items, status=None):
+        """
+        写入 (模型, 方法, 协议) 的全部结果，覆盖该分区原有的内容。条目数与原来的文件名一样取 len(items)。
+        Args:
+            items (list): 已提取 model_ans 的结果条目（与 .pkl 中的格式相同）。
+            status (dict): 运行状态，保存在分区文件的元数据中，用 read_status 读取。
+        Returns:
+            str: 分区文件路径。
+        """
+        _require_pyarrow()
+        rows = [{
+            "id": item["id"],
+            "protocol_result": item.get("protocol_result"),
+            "model_ans": item.get("model_ans"),
+            "vote_labels": item.get("vote_labels"),
+            "votes_used": item.get("votes_used"),
+            "label_probs": item.get("label_probs"),
+            "label_mass": item.get("label_mass"),
+        } for item in items]
+        path = self._partition_path(model_name, len(items), method, protocol_type)
+        table = pa.Table.from_pylist(rows, schema=RESULT_SCHEMA)
+        if status is not None:
+            table = table.replace_schema_metadata({"status": json.dumps(status, ensure_ascii=False)})
+        _write_table(table, path)
+        return path
+
+    def read_status(self, model_name, length, method, protocol_type):
+        """
+        读取分区的运行状态，与 result_writer.read_status 相同。
+        Returns:
+            dict: 运行状态；分区不存在或没有保存状态时为 None。
+        """
+        _require_pyarrow()
+        path = self._partition_path(model_name, length, method, protocol_type)
+        if not os.path.exists(path):
+            return None
+        metadata = pq.read_schema(path).metadata or {}
+        return json.loads(metadata[b"status"]) if b"status" in metadata else None
+
+    def read_results(self, columns=None, model_name=None, method=None, protocol_type=None, length=None):
+        """
+        读取结果表，只加载 columns 中的列（可包含分区列 model、length、method、protocol）和匹配的分区。
+        Returns:
+            pyarrow.Table: 查询结果，method 为 "" 的分区以 "none" 表示。
+        """
+        _require_pyarrow()
+        dataset = ds.dataset(self._results_dir(), format="parquet",
+                             schema=pa.unify_schemas([RESULT_SCHEMA, PARTITION_SCHEMA]),
+                             partitioning=ds.partitioning(PARTITION_SCHEMA, flavor="hive"))
+        condition = None
+        for field, value in (("model", model_name), ("length", length),
+                             ("method", None if method is None else method or "none"), ("protocol", protocol_type)):
+            if value is not None:
+                expr = ds.field(field) == value
+                condition = expr if condition is None else condition & expr
+        return dataset.to_table(columns=columns, filter=condition)
+
+    def open_writer(self, model_name, method, protocol_type, finalize, on_saved=None, sort_key=None):
+        """
+        创建与 result_writer.ResultWriter 接口相同的写入器，结果写入本存储。
+        sort_key 不为 None 时分区文件中的结果按 sort_key 排序。
+        """
+        return StoreWriter(self, model_name, method, protocol_type, finalize, on_saved, sort_key)
+
+    def export_json(self, model_name, length, method, protocol_type, output_dir="output",
+                    base_filename="CommonSense_results", dataset="CommonSense", indent=4):
+        """
+        兼容导出：按原有的文件名和字段顺序生成 output/{model}/ 下的 .json 结果文件。
+        Returns:
+            str: 生成的文件路径。
+        """
+        results = self.read_results(["id", "protocol_result", "model_ans", "vote_labels", "votes_used",
+                                     "label_probs", "label_mass"],
+                                    model_name, method, protocol_type, length).to_pylist()
+        questions = {row["id"]: row for row in self.read_questions(dataset).to_pylist()}
+        items = []
+        for row in results:
+            question = questions.get(row["id"], {})
+            item = {"id": row["id"]}
+            if question:
+                item["question"] = question["question"]
+                item["choices"] = question["choices"]
+            item["protocol_result"] = row["protocol_result"]
+            if row["vote_labels"] is not None:
+                item["vote_labels"] = row["vote_labels"]
+            if row["votes_used"] is not None:
+                item["votes_used"] = row["votes_used"]
+            if row["label_probs"] is not None:
+                item["label_probs"] = dict(row["label_probs"])
+                item["label_mass"] = row["label_mass"]
+            if row["model_ans"] is not None:
+                item["model_ans"] = row["model_ans"]
+            if question:
+                item["correct_ans"] = question["answerKey"]
+            items.append(item)
+
+        path = os.path.join(output_dir, model_name, f"{base_filename}_{len(items)}{method}_{protocol_type}.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(items, f, ensure_ascii=False, indent=indent)
+        return path
+
+    def import_json(self, json_path, model_name, method, protocol_type, dataset="CommonSense"):
+        """
+        把已有的 .json 结果文件导入存储（问题写入问题表，结果写入对应分区）。
+        """
+        with open(json_path, "r", encoding="utf-8") as f:
+            items = json.load(f)
+        self.write_questions([{"id": item["id"], "question": item["question"], "choices": item["choices"],
+                               "answerKey": item["correct_ans"]} for item in items if "question" in item], dataset)
+        return self.write_results(model_name, method, protocol_type, items)
+
+
+class StoreWriter:
+    """
+    把一个 (模型, 协议) 的结果写入 ResultStore。答案提取在后台线程中进行，finish() 后写出分区文件。
+    """
+
+    def __init__(self, store, model_name, method, protocol_type, finalize, on_saved=None, sort_key=None):
+        self.store = store
+        self.model_name = model_name
+        self.method = method
+        self.protocol_type = protocol_type
+        self.finalize = finalize
+        self.on_saved = on_saved
+        self.sort_key = sort_key
+        self.status = None
+        self.path = None
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name=f"store-{protocol_type}", daemon=True)
+        self._thread.start()
+
+    def add(self, item):
+        self._queue.put(item)
+
+    def finish(self, status=None):
+        self.status = status
+        self._queue.put(None)
+
+    def wait(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self.path
+
+    def close(self):
+        self.finish()
+        return self.wait()
+
+    def _run(self):
+        items = []
+        drained = False
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    drained = True
+                    break
+                items.append(self.finalize(item))
+            if self.sort_key is not None:
+                items.sort(key=self.sort_key)
+            self.path = self.store.write_results(self.model_name, self.method, self.protocol_type, items,
+                                                 status=self.status)
+            if self.on_saved is not None:
+                self.on_saved(self.path, items)
+        except Exception as e:
+            self._error = e
+            while not drained:
+                drained = self._queue.get() is None
+
+
+# 结果文件名：CommonSense_results_{数据量}{方法}_{协议}.json。协议名本身含下划线（Correct_Guidance），
+# 必须逐个列出，否则方法和协议的分界会落在协议名内部
+_RESULT_FILE_PATTERN = re.compile(
+    r'^CommonSense_results_(\d+)(.*?)_(Raw|Correct_Guidance|Wrong_Guidance|Trust|Doubt)\.json$')
+
+
+if __name__ == "__main__":
+    # 把 output/ 下已有的 .json 结果迁移到列式存储，并对比占用的空间
+    store = ResultStore("store")
+    for json_path in sorted(glob.glob(os.path.join("output", "*", "CommonSense_results_*.json"))):
+        match = _RESULT_FILE_PATTERN.match(os.path.basename(json_path))
+        if not match:
+            continue
+        model = os.path.basename(os.path.dirname(json_path))
+        partition = store.import_json(json_path, model, match.group(2), match.group(3))
+        print(f"{json_path} -> {partition}")
+
+    def dir_size(path):
+        return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+    print(f"output/ 占用 {dir_size('output') / 1024 ** 2:.1f} MB，store/ 占用 {dir_size('store') / 1024 ** 2:.1f} MB")
@@ -0,0 +1,176 @@
+import json
+import os
+import pickle
+import queue
+import threading
+
+
+def to_json_item(item):
+    """
+    把 .pkl 中的结果条目转换为 .json 中的格式：去掉 q_content，answerKey 改名为 correct_ans。
+    """
+    new_item = {k: v for k, v in item.items() if k != "q_content"}
+    if "answerKey" in new_item:
+        new_item["correct_ans"] = new_item.pop("answerKey")
+    if "model_res" in new_item:
+        del new_item["protocol_result"]
+    return new_item
+
+
+def status_path(json_path):
+    """
+    结果文件旁的运行状态文件：把 .json 换成 .status.json。
+    """
+    return json_path[:-len(".json")] + ".status.json"
+
+
+def read_status(json_path):
+    """
+    读取结果文件的运行状态（已处理 / 应处理的问题数、是否提前停止、是否完整）。
+    Returns:
+        dict: 运行状态；没有状态文件（旧结果，或不是由实验运行写出的结果）时为 None。
+    """
+    path = status_path(json_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class ResultWriter:
+    """
+    单个 (模型, 协议) 的流式结果写入器。
+    - add() 只把结果放进队列，答案提取和写文件都在后台线程中进行，不阻塞调用方；
+    - 每条结果到达时只提取一次答案；
+    - 没有 sort_key 时结果按到达顺序随即追加到 .json（写入 .part 临时文件）；给出 sort_key 时先缓存提取后的条目，
+      finish() 后按 sort_key 排序一次写出 .json，文件内容与到达顺序无关，每个文件只写一次；
+    - finish() 后写出 .pkl（pickle 无法逐条追加成一个列表，只在结束时序列化一次），
+      再把两个文件改名为 f"{name_prefix}{条目数}{name_suffix}.pkl/.json"；
+    - json_indent 为 4 时与 json.dump(..., indent=4) 的输出逐字节相同，为 None 时写紧凑的单行 JSON。
+    finish(status) 给出运行状态时另外写出 .status.json，下游据此区分完整和不完整（提前停止、达到预算）的结果。
+    """
+
+    def __init__(self, output_dir, name_prefix, name_suffix, finalize, json_indent=4, on_saved=None, sort_key=None):
+        """
+        Args:
+            output_dir (str): 输出目录。
+            name_prefix (str): 文件名中条目数之前的部分。
+            name_suffix (str): 文件名中条目数之后、扩展名之前的部分。
+            finalize (callable): finalize(item) 返回写入 .pkl 的条目（已提取 model_ans）。
+            json_indent (int): .json 的缩进，None 为紧凑格式。
+            on_saved (callable): 保存完成后调用 on_saved(pkl_path, json_path, pkl_items)。
+            sort_key (callable): 最终文件中结果的排序键，None 时保持到达顺序。
+        """
+        self.output_dir = output_dir
+        self.name_prefix = name_prefix
+        self.name_suffix = name_suffix
+        self.finalize = finalize
+        self.json_indent = json_indent
+        self.on_saved = on_saved
+        self.sort_key = sort_key
+        self.status = None
+        self.paths = None
+        self._queue = queue.Queue()
+        self._error = None
+        self._drained = False
+        self._thread = threading.Thread(target=self._run, name=f"writer-{name_suffix}", daemon=True)
+        self._thread.start()
+
+    def add(self, item):
+        """
+        添加一条结果。线程安全。
+        """
+        self._queue.put(item)
+
+    def finish(self, status=None):
+        """
+        不再添加结果，后台线程写完剩余结果后保存文件。立即返回。
+        Args:
+            status (dict): 运行状态，写入 .status.json；为 None 时不写，并删除同名的旧状态文件。
+        """
+        self.status = status
+        self._queue.put(None)
+
+    def wait(self):
+        """
+        等待保存完成。
+        Returns:
+            tuple: (pkl 路径, json 路径)。
+        """
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self.paths
+
+    def close(self):
+        self.finish()
+        return self.wait()
+
+    def _format(self, item, first):
+        if self.json_indent is None:
+            return ("" if first else ", ") + json.dumps(item, ensure_ascii=False)
+        pad = " " * self.json_indent
+        text = json.dumps(item, ensure_ascii=False, indent=self.json_indent)
+        return ("\n" if first else ",\n") + "\n".join(pad + line for line in text.split("\n"))
+
+    def _closing(self, pkl_items):
+        return "\n]" if pkl_items and self.json_indent is not None else "]"
+
+    def _write_json(self, path, pkl_items):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("[")
+            for i, pkl_item in enumerate(pkl_items):
+                f.write(self._format(to_json_item(pkl_item), i == 0))
+            f.write(self._closing(pkl_items))
+
+    def _results(self):
+        """
+        依次取出队列中的结果并提取答案，直到 finish()。
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._drained = True
+                return
+            yield self.finalize(item)
+
+    def _save(self, part_path, pkl_items):
+        """
+        .json 已完整写入 .part 后保存文件：写出 .pkl、改名，并写出或删除状态文件。
+        """
+        stem = os.path.join(self.output_dir, f"{self.name_prefix}{len(pkl_items)}{self.name_suffix}")
+        pkl_path, json_path = stem + ".pkl", stem + ".json"
+        with open(pkl_path + ".tmp", "wb") as f:
+            pickle.dump(pkl_items, f)
+        os.replace(pkl_path + ".tmp", pkl_path)
+        os.replace(part_path, json_path)
+        if self.status is not None:
+            with open(status_path(json_path), "w", encoding="utf-8") as f:
+                json.dump(self.status, f, ensure_ascii=False, indent=4)
+        elif os.path.exists(status_path(json_path)):
+            os.remove(status_path(json_path))  # 旧的状态描述的是被覆盖的结果
+        self.paths = (pkl_path, json_path)
+
+    def _run(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        part_path = os.path.join(self.output_dir, f"{self.name_prefix}{self.name_suffix}.json.part")
+        try:
+            if self.sort_key is None:
+                pkl_items = []
+                with open(part_path, "w", encoding="utf-8") as f:
+                    f.write("[")
+                    for pkl_item in self._results():
+                        f.write(self._format(to_json_item(pkl_item), not pkl_items))
+                        pkl_items.append(pkl_item)
+                    f.write(self._closing(pkl_items))
+            else:
+                pkl_items = sorted(self._results(), key=self.sort_key)
+                self._write_json(part_path, pkl_items)
+            self._save(part_path, pkl_items)
+            if self.on_saved is not None:
+                self.on_saved(*self.paths, pkl_items)
+        except Exception as e:
+            self._error = e
+            # 出错后继续取走队列中的结果直到 finish()，让 wait() 能够返回并抛出错误
+            while not self._drained:
+                self._drained = self._queue.get() is None
@@ -0,0 +1,250 @@
+import asyncio
+import collections
+import email.utils
+import random
+import re
+import threading
+import time
+
+import openai
+
+# 退避抖动使用独立的随机数生成器，不影响实验中用于构造提示的全局随机种子
+_jitter_random = random.Random()
+
+# 可重试的 HTTP 状态码：超时、冲突、限流和服务端错误
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class FatalRequestError(Exception):
+    """
+    请求成功返回、但内容说明重试也不会成功的错误，例如后端不支持请求的参数。classify_error 将其归为不可重试。
+    """
+
+
+def classify_error(exc):
+    """
+    将请求异常分为可重试 ("retryable") 和不可重试 ("fatal") 两类。
+    - 连接错误、超时、限流 (429) 和 5xx 可重试；
+    - 其余 4xx（模型名错误、鉴权失败、上下文超长等）重试也不会成功，直接放弃；
+    - FatalRequestError 不可重试；
+    - 其余非 HTTP 异常（例如返回内容为空导致的处理错误）按原有行为重试。
+    Args:
+        exc (Exception): 请求抛出的异常。
+    Returns:
+        str: "retryable" 或 "fatal"。
+    """
+    if isinstance(exc, FatalRequestError):
+        return "fatal"
+    if isinstance(exc, openai.APIConnectionError):  # 包含 APITimeoutError
+        return "retryable"
+    status_code = getattr(exc, "status_code", None)
+    if status_code is None:
+        return "retryable"
+    if status_code in RETRYABLE_STATUS_CODES or status_code >= 500:
+        return "retryable"
+    return "fatal"
+
+
+def _parse_duration(value):
+    """
+    解析限流响应头中的时长，支持 "2"、"0.5"、"20ms"、"1s"、"6m0s"、"1h2m3s" 等格式。
+    Returns:
+        float: 秒数，无法解析时为 None。
+    """
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not parts or "".join(n + u for n, u in parts) != value:
+        return None
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(n) * scale[u] for n, u in parts)
+
+
+def retry_after_seconds(exc):
+    """
+    从异常对应的 HTTP 响应头中读取服务端要求的等待时间。
+    依次检查 retry-after-ms、retry-after（秒数或 HTTP 日期）以及 429 响应的 x-ratelimit-reset-* 头。
+    Returns:
+        float: 等待秒数，响应中没有相关信息时为 None。
+    """
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        seconds = _parse_duration(retry_after)
+        if seconds is not None:
+            return max(0.0, seconds)
+        try:
+            retry_date = email.utils.parsedate_to_datetime(retry_after)
+            return max(0.0, retry_date.timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+
+    if getattr(exc, "status_code", None) == 429:
+        resets = [_parse_duration(headers[name]) for name in
+                  ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens") if headers.get(name)]
+        resets = [r for r in resets if r is not None]
+        if resets:
+            return max(resets)
+    return None
+
+
+class CircuitBreaker:
+    """
+    所有工作线程 / 协程共享的熔断器。
+    最近 window 次请求中错误比例达到 error_threshold 时打开熔断，冷却 cooldown 秒内所有请求暂停；
+    收到 Retry-After 时也通过 pause 让所有请求一起等待，避免继续加重服务端负载。
+    print_lock 为调用方控制打印输出的锁，熔断提示与工作线程的输出不会交错。
+    """
+
+    def __init__(self, window=50, error_threshold=0.5, min_requests=20, cooldown=30.0, print_lock=None):
+        self.error_threshold = error_threshold
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.trips = 0
+        self._outcomes = collections.deque(maxlen=window)
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+        self.print_lock = print_lock if print_lock is not None else threading.Lock()
+
+    def record(self, success):
+        """
+        记录一次请求结果，错误率超过阈值时打开熔断。
+        """
+        with self._lock:
+            self._outcomes.append(bool(success))
+            if len(self._outcomes) < self.min_requests or time.monotonic() < self._open_until:
+                return
+            error_rate = self._outcomes.count(False) / len(self._outcomes)
+            if error_rate < self.error_threshold:
+                return
+            self._open_until = time.monotonic() + self.cooldown
+            self._outcomes.clear()
+            self.trips += 1
+        with self.print_lock:
+            print(f"错误率 {error_rate:.0%} 超过阈值，熔断 {self.cooldown:.0f} 秒，暂停所有请求。")
+
+    def pause(self, seconds):
+        """
+        让所有请求至少暂停 seconds 秒。
+        """
+        with self._lock:
+            self._open_until = max(self._open_until, time.monotonic() + seconds)
+
+    def remaining(self):
+        """
+        返回熔断剩余的秒数，未熔断时为 0。
+        """
+        with self._lock:
+            return max(0.0, self._open_until - time.monotonic())
+
+    def wait(self):
+        while True:
+            remaining = self.remaining()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    async def wait_async(self):
+        while True:
+            remaining = self.remaining()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+
+
+class RetryPolicy:
+    """
+    请求重试策略：区分可重试与不可重试错误，使用带完全抖动 (full jitter) 的指数退避，
+    优先遵循服务端返回的 Retry-After / 限流头，并与共享的熔断器配合。
+    """
+
+    def __init__(self, max_delay=60.0, breaker=None):
+        self.max_delay = max_delay
+        self.breaker = breaker
+
+    def compute_delay(self, attempt, exc, base_delay):
+        """
+        计算第 attempt 次失败后的等待时间。
+        服务端给出 Retry-After 时等待该时长再加少量抖动，避免所有请求在同一时刻重发。
+        Returns:
+            tuple: (等待秒数, 服务端要求的等待秒数或 None)。
+        """
+        retry_after = retry_after_seconds(exc)
+        if retry_after is not None:
+            return retry_after + _jitter_random.uniform(0, min(base_delay, retry_after)), retry_after
+        return _jitter_random.uniform(0, min(self.max_delay, base_delay * 2 ** (attempt - 1))), None
+
+    def _on_failure(self, attempt, exc, max_retries, base_delay, on_error):
+        """
+        处理一次失败，返回需要等待的秒数；不应再重试时返回 None。
+        """
+        kind = classify_error(exc)
+        if kind == "retryable" and self.breaker is not None:
+            self.breaker.record(False)
+        if on_error is not None:
+            on_error(attempt, exc, kind)
+        if kind == "fatal" or attempt >= max_retries:
+            return None
+        delay, retry_after = self.compute_delay(attempt, exc, base_delay)
+        if retry_after is not None and self.breaker is not None:
+            self.breaker.pause(retry_after)
+        return delay
+
+    def call(self, fn, max_retries=50, base_delay=2.0, on_error=None):
+        """
+        按重试策略调用 fn()。
+        Args:
+            fn (callable): 发送一次请求的函数。
+            max_retries (int): 最大尝试次数。
+            base_delay (float): 指数退避的基础延迟秒数。
+            on_error (callable): 每次失败时调用 on_error(attempt, exc, kind)。
+        Returns:
+            fn() 的返回值；遇到不可重试错误或次数用尽时抛出最后一次的异常。
+        """
+        for attempt in range(1, max_retries + 1):
+            if self.breaker is not None:
+                self.breaker.wait()
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self._on_failure(attempt, e, max_retries, base_delay, on_error)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            else:
+                if self.breaker is not None:
+                    self.breaker.record(True)
+                return result
+
+    async def call_async(self, fn, max_retries=50, base_delay=2.0, on_error=None):
+        """
+        call 的异步版本，fn() 返回一个可等待对象。
+        """
+        for attempt in range(1, max_retries + 1):
+            if self.breaker is not None:
+                await self.breaker.wait_async()
+            try:
+                result = await fn()
+            except Exception as e:
+                delay = self._on_failure(attempt, e, max_retries, base_delay, on_error)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+            else:
+                if self.breaker is not None:
+                    self.breaker.record(True)
+                return result
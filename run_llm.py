@@ -110,17 +110,41 @@ import os
 import time
 import random
 
+from http_transport import ConnectionStats, build_http_client
+from response_cache import ResponseCache
+from retry_policy import CircuitBreaker, RetryPolicy
+from token_usage import TokenLedger
+
 # 从环境变量中获取 API 密钥和 URL
 serverless_api = os.getenv('serverless_api')
-serverless_url = "https://ai.gitee.com/v1"
+serverless_url = os.getenv('serverless_url', "https://ai.gitee.com/v1")
+
+# HTTP 连接统计与传输设置，与 pipeline.py 使用同一套实现；本脚本逐个发送请求，连接池不需要很大
+connection_stats = ConnectionStats()
+http_client = build_http_client(max_connections=16, max_keepalive=16, keepalive_expiry=30.0, http2=False,
+                                connect_timeout=10.0, read_timeout=600.0, stats=connection_stats)
 
 # 初始化 OpenAI 客户端
 client = OpenAI(
     api_key=serverless_api,
     base_url=serverless_url,
-    default_headers={"X-Failover-Enabled": "true"}
+    default_headers={"X-Failover-Enabled": "true"},
+    max_retries=0,  # 重试由 retry_policy 统一负责
+    http_client=http_client,
+    timeout=http_client.timeout,  # OpenAI 客户端的超时会覆盖 httpx 客户端的设置
 )
 
+# 响应缓存："off" 关闭，"readwrite" 读写，"replay" 只读回放（未命中不请求 API）
+cache_mode = "readwrite"
+response_cache = None if cache_mode == "off" else ResponseCache(
+    "cache", max_bytes=2 * 1024 ** 3, read_only=(cache_mode == "replay"))
+
+# 重试策略，与 pipeline.py 使用同一套实现
+retry_policy = RetryPolicy(max_delay=60.0, breaker=CircuitBreaker(window=100, error_threshold=0.5, cooldown=30.0))
+
+# token 用量账本，与 pipeline.py 使用同一套实现；本脚本不区分方法和协议
+token_ledger = TokenLedger()
+
 # 定义要使用的模型列表
 models = ["DeepSeek-R1-Distill-Qwen-14B", "Qwen2-7B-Instruct", "glm-4-9b-chat"]
 
@@ -157,33 +181,48 @@ def my_request(messages, model_name, max_retries=50, retry_delay=2):
         messages (list): 聊天消息列表。
         model_name (str): 要使用的模型名称。
         max_retries (int): 最大重试次数。
-        retry_delay (int): 重试之间的延迟秒数。
+        retry_delay (int): 指数退避的基础延迟秒数。
     Returns:
         str: 模型的响应内容，如果请求失败则为 None。
     """
-    for attempt in range(1, max_retries + 1):
-        try:
-            response = client.chat.completions.create(
-                model=model_name,
-                stream=False,
-                max_tokens=1024,
-                temperature=0.6,
-                top_p=0.7,
-                extra_body={
-                    "top_k": 50,
-                },
-                frequency_penalty=0,
-                messages=messages
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            print(f"Attempt {attempt} failed with error: {e}")
-            if attempt < max_retries:
-                print(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
-            else:
-                print("Max retries reached. Request failed.")
-                return None
+    cache_key = None
+    if response_cache is not None:
+        cache_key = ResponseCache.make_key(model_name, messages, 1024, 0.6, 0.7, 50)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        if response_cache.read_only:
+            return None  # 回放模式下未命中的请求视为失败
+
+    def attempt():
+        response = client.chat.completions.create(
+            model=model_name,
+            stream=False,
+            max_tokens=1024,
+            temperature=0.6,
+            top_p=0.7,
+            extra_body={
+                "top_k": 50,
+            },
+            frequency_penalty=0,
+            messages=messages
+        )
+        content = response.choices[0].message.content
+        token_ledger.record(model_name, "", "all", response.usage, content)
+        return content
+
+    def on_error(attempt_number, exc, kind):
+        print(f"Attempt {attempt_number} failed with {'non-retryable ' if kind == 'fatal' else ''}error: {exc}")
+
+    try:
+        content = retry_policy.call(attempt, max_retries, retry_delay, on_error=on_error)
+    except Exception as e:
+        print(f"Request failed: {e}")
+        return None
+
+    if cache_key is not None:
+        response_cache.put(cache_key, content)
+    return content
 
 
 def _get_agent_opinion_message(answer_content):
@@ -527,10 +566,15 @@ def main_experiment(data_file_path, model_name="Qwen2-7B-Instruct"):
 
 
     print("\n--- 所有问题处理完毕 ---")
+    if response_cache is not None:
+        print(response_cache.report())
+    print(connection_stats.report())
     # 可以将 all_results 保存到 JSON 文件中
     with open("experiment_results.json", "w", encoding="utf-8") as f:
         json.dump(all_results, f, ensure_ascii=False, indent=4)
     print("\n实验结果已保存到 experiment_results.json")
+    token_ledger.save("experiment_token_usage.json", model_name)
+    print(token_ledger.report(model_name))
 
     return all_results
 
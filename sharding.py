@@ -0,0 +1,185 @@
+import glob
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+
+_SHARD_FILE_PATTERN = re.compile(r'\.shard-(\d+)-of-(\d+)\.jsonl$')
+
+
+def shard_of(qa_id, num_shards):
+    """
+    问题所属的分片：对 id 做 SHA-1 后取模，与机器、进程和 Python 的哈希随机化无关。
+    Args:
+        qa_id (str): 问题 id。
+        num_shards (int): 分片数。
+    Returns:
+        int: 分片序号，0 到 num_shards - 1。
+    """
+    return int(hashlib.sha1(str(qa_id).encode("utf-8")).hexdigest(), 16) % num_shards
+
+
+def select_shard(qa_dataset, shard_index, num_shards):
+    """
+    返回数据集中属于第 shard_index 个分片的问题，保持原有顺序。
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard_index 必须在 0 到 {num_shards - 1} 之间，当前为 {shard_index}")
+    return [qa_item for qa_item in qa_dataset if shard_of(qa_item['id'], num_shards) == shard_index]
+
+
+def shard_label(shard_index, num_shards):
+    """
+    分片在文件名中的标记，例如 "shard-002-of-008"。
+    """
+    return f"shard-{shard_index:03d}-of-{num_shards:03d}"
+
+
+def shard_files(directory, name, extension=".jsonl"):
+    """
+    列出目录下某个文件的全部分片（{name}.shard-XXX-of-YYY{extension}），按文件名排序。
+    """
+    pattern = glob.escape(name) + ".shard-*-of-*" + glob.escape(extension)
+    return sorted(glob.glob(os.path.join(glob.escape(directory), pattern)))
+
+
+def read_shard(path):
+    """
+    读取一个分片文件。
+    Returns:
+        list: 分片中的结果条目，按写入顺序排列。
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def verify_shards(paths, expected_ids, num_shards):
+    """
+    检查一组分片能否合并成完整的结果：
+    - 每个分片序号 0 到 num_shards - 1 都恰好有一个文件，且文件名中的分片数与 num_shards 一致；
+    - 每个问题 id 只出现一次，且出现在按哈希应属于的分片中；
+    - 数据集中的每个问题都有结果，没有数据集之外的问题。
+    Args:
+        paths (list): 分片文件路径。
+        expected_ids (list): 数据集中的全部问题 id。
+        num_shards (int): 分片数。
+    Returns:
+        dict: 检查结果，ok 为 True 时可以合并；其余字段列出发现的问题。
+    """
+    report = {"ok": True, "items": 0, "missing_shards": [], "extra_files": [], "missing_ids": [],
+              "duplicate_ids": {}, "unexpected_ids": [], "misplaced_ids": [], "error_ids": []}
+    found_shards = {}
+    seen = {}
+    for path in paths:
+        match = _SHARD_FILE_PATTERN.search(path)
+        if not match or int(match.group(2)) != num_shards or int(match.group(1)) in found_shards:
+            report["extra_files"].append(path)
+            continue
+        shard_index = int(match.group(1))
+        found_shards[shard_index] = path
+        for item in read_shard(path):
+            qa_id = item.get("id")
+            report["items"] += 1
+            seen.setdefault(qa_id, []).append(path)
+            if shard_of(qa_id, num_shards) != shard_index:
+                report["misplaced_ids"].append(qa_id)
+            result = item.get("protocol_result")
+            if not isinstance(result, str) or result.startswith("ERROR:"):
+                report["error_ids"].append(qa_id)
+
+    expected = set(expected_ids)
+    report["missing_shards"] = [i for i in range(num_shards) if i not in found_shards]
+    report["missing_ids"] = [qa_id for qa_id in expected_ids if qa_id not in seen]
+    report["duplicate_ids"] = {qa_id: files for qa_id, files in seen.items() if len(files) > 1}
+    report["unexpected_ids"] = [qa_id for qa_id in seen if qa_id not in expected]
+    # 请求失败的问题与单机运行一样照常保存，只作提示，不影响合并
+    report["ok"] = not any(report[field] for field in ("missing_shards", "extra_files", "missing_ids",
+                                                       "duplicate_ids", "unexpected_ids", "misplaced_ids"))
+    return report
+
+
+def format_report(name, report):
+    """
+    返回分片检查结果的文字描述。
+    """
+    status = "可以合并" if report["ok"] else "不能合并"
+    text = f"{name}：{report['items']} 条结果，{status}"
+    labels = [("missing_shards", "缺少分片"), ("extra_files", "多余或不匹配的文件"), ("missing_ids", "缺失的问题"),
+              ("duplicate_ids", "重复的问题"), ("unexpected_ids", "数据集之外的问题"),
+              ("misplaced_ids", "不属于所在分片的问题"), ("error_ids", "请求失败的问题")]
+    for field, label in labels:
+        values = list(report[field])
+        if values:
+            shown = ", ".join(str(v) for v in values[:5]) + (" ..." if len(values) > 5 else "")
+            text += f"\n  {label} {len(values)} 个：{shown}"
+    return text
+
+
+def merge_shards(paths):
+    """
+    合并分片中的结果，按问题 id 排序，与分片数和各节点的完成顺序无关。合并前应先用 verify_shards 检查。
+    Returns:
+        list: 全部结果条目。
+    """
+    items = [item for path in paths for item in read_shard(path)]
+    items.sort(key=lambda x: x.get('id', ''))
+    return items
+
+
+class ShardWriter:
+    """
+    与 result_writer.ResultWriter 接口相同的分片写入器：结果原样（未提取答案）逐行写入 .part 临时文件，
+    finish() 后改名为正式的分片文件，合并时再统一提取答案、生成标准结果文件。
+    finalize 只为在线指标等回调而调用，返回值不写入文件。
+    finish() 的运行状态不写入分片：分片是否完整由合并时的 verify_shards 检查，合并后的结果总是完整的。
+    """
+
+    def __init__(self, path, finalize=None, on_saved=None):
+        self.path = path
+        self.finalize = finalize
+        self.on_saved = on_saved
+        self.count = 0
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name=f"shard-{os.path.basename(path)}", daemon=True)
+        self._thread.start()
+
+    def add(self, item):
+        self._queue.put(item)
+
+    def finish(self, status=None):
+        self._queue.put(None)
+
+    def wait(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self.path
+
+    def close(self):
+        self.finish()
+        return self.wait()
+
+    def _run(self):
+        drained = False
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path + ".part", "w", encoding="utf-8") as f:
+                while True:
+                    item = self._queue.get()
+                    if item is None:
+                        drained = True
+                        break
+                    if self.finalize is not None:
+                        self.finalize(item)
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+                    self.count += 1
+            os.replace(self.path + ".part", self.path)
+            if self.on_saved is not None:
+                self.on_saved(self.path, self.count)
+        except Exception as e:
+            self._error = e
+            while not drained:
+                drained = self._queue.get() is None
@@ -0,0 +1,406 @@
+import contextlib
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+
+# 当前请求所属的模型、协议和入队时间，由调度代码通过 request_scope 设置。
+# 线程池中的任务需要用 contextvars.copy_context().run 提交才能继承这些值。
+request_model = contextvars.ContextVar("request_model", default="")
+request_protocol = contextvars.ContextVar("request_protocol", default="")
+request_enqueued_at = contextvars.ContextVar("request_enqueued_at", default=None)
+_current_call = contextvars.ContextVar("current_call", default=None)
+
+# 直方图的桶上界（秒 / 次）
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, math.inf)
+ATTEMPT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, math.inf)
+CHAR_BUCKETS = (0, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, math.inf)  # 推理字符数
+
+
+@contextlib.contextmanager
+def request_scope(model=None, protocol=None, enqueued_at=None):
+    """
+    在 with 块内设置当前请求的模型、协议和入队时间 (time.monotonic())，为 None 的项保持不变。
+    """
+    tokens = []
+    for var, value in ((request_model, model), (request_protocol, protocol), (request_enqueued_at, enqueued_at)):
+        if value is not None:
+            tokens.append((var, var.set(value)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def scoped_context(model=None, protocol=None, enqueued_at=None):
+    """
+    复制当前上下文并设置模型、协议和入队时间，用于 executor.submit(ctx.run, fn, ...)。
+    每个任务需要单独的上下文副本。
+    """
+    ctx = contextvars.copy_context()
+
+    def set_values():
+        for var, value in ((request_model, model), (request_protocol, protocol), (request_enqueued_at, enqueued_at)):
+            if value is not None:
+                var.set(value)
+
+    ctx.run(set_values)
+    return ctx
+
+
+def error_class(exc):
+    """
+    异常的分类名称：HTTP 错误为状态码，其他为异常类名。
+    """
+    status_code = getattr(exc, "status_code", None)
+    return str(status_code) if status_code is not None else type(exc).__name__
+
+
+def note_error(exc):
+    """
+    记录当前请求的一次失败尝试，供重试策略的失败回调调用。
+    """
+    call = _current_call.get()
+    if call is not None:
+        call.errors.append(error_class(exc))
+
+
+def _on_request(request):
+    call = _current_call.get()
+    if call is not None:
+        call.attempt_started = time.perf_counter()
+
+
+def _on_response(response):
+    # httpx 在读取响应头之后、读取响应体之前调用，此时的耗时即首字节时间
+    call = _current_call.get()
+    if call is not None:
+        if call.attempt_started is not None:
+            call.ttfb = time.perf_counter() - call.attempt_started
+        call.status = str(response.status_code)
+
+
+async def _on_request_async(request):
+    _on_request(request)
+
+
+async def _on_response_async(response):
+    _on_response(response)
+
+
+def event_hooks():
+    """
+    httpx.Client 的 event_hooks，用于记录首字节时间和 HTTP 状态码。
+    """
+    return {"request": [_on_request], "response": [_on_response]}
+
+
+def async_event_hooks():
+    """
+    httpx.AsyncClient 的 event_hooks。
+    """
+    return {"request": [_on_request_async], "response": [_on_response_async]}
+
+
+class RequestRecord:
+    """
+    一次 my_request 调用（包括全部重试）的遥测数据。
+    """
+
+    def __init__(self, model, protocol, queue_wait):
+        self.model = model
+        self.protocol = protocol
+        self.queue_wait = queue_wait
+        self.attempts = 0
+        self.errors = []
+        self.status = None
+        self.ttfb = None
+        self.latency = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.attempt_started = None
+        self.ttft = None  # 流式请求的首 token 时间
+        self.reasoning_chars = None
+        self.stopped_early = False
+
+    def begin_attempt(self):
+        self.attempts += 1
+        self.attempt_started = time.perf_counter()
+        self.ttfb = None
+        self.ttft = None
+
+    def record_stream(self, first_token_at, reasoning_chars, stopped_early):
+        """
+        记录流式请求的首 token 时间 (time.perf_counter())、推理字符数和是否在解析到答案后提前结束。
+        """
+        if first_token_at is not None and self.attempt_started is not None:
+            self.ttft = first_token_at - self.attempt_started
+        self.reasoning_chars = reasoning_chars
+        self.stopped_early = stopped_early
+
+    def record_usage(self, usage):
+        """
+        记录 response.usage 中的 token 数，usage 为空时忽略。
+        """
+        if usage is None:
+            return
+        self.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+        self.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+
+
+class Histogram:
+    """
+    固定桶的累计直方图，与 Prometheus 的 histogram 类型对应。
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        根据桶计数线性插值估计分位数，没有数据时返回 None。
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for upper, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                if math.isinf(upper):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper
+        return lower
+
+
+class Telemetry:
+    """
+    按 (模型, 协议) 汇总请求遥测：延迟、首字节时间、首 token 时间、排队时间、尝试次数和推理字符数的直方图，
+    请求结果、失败尝试、流式提前结束次数和 token 数的计数器。定时导出为 Prometheus 文本和 JSON 快照。
+    """
+
+    HISTOGRAMS = {
+        "llm_request_latency_seconds": SECONDS_BUCKETS,
+        "llm_request_ttfb_seconds": SECONDS_BUCKETS,
+        "llm_request_ttft_seconds": SECONDS_BUCKETS,
+        "llm_reasoning_chars": CHAR_BUCKETS,
+        "llm_request_queue_wait_seconds": SECONDS_BUCKETS,
+        "llm_request_attempts": ATTEMPT_BUCKETS,
+    }
+
+    def __init__(self, export_dir="telemetry", interval=15.0):
+        self.export_dir = export_dir
+        self.interval = interval
+        self._histograms = {}  # (名称, 标签元组) -> Histogram
+        self._counters = {}  # (名称, 标签元组) -> 数值
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @contextlib.contextmanager
+    def track(self, model_name):
+        """
+        跟踪一次请求（包括全部重试），退出时汇总。with 块内抛出的异常会照常向外传播。
+        Yields:
+            RequestRecord: 请求代码在每次尝试前调用 begin_attempt()，成功后调用 record_usage()。
+        """
+        enqueued_at = request_enqueued_at.get()
+        queue_wait = time.monotonic() - enqueued_at if enqueued_at is not None else None
+        call = RequestRecord(model_name or request_model.get(), request_protocol.get(), queue_wait)
+        token = _current_call.set(call)
+        start = time.perf_counter()
+        try:
+            yield call
+        except BaseException as e:
+            call.status = error_class(e)
+            raise
+        finally:
+            call.latency = time.perf_counter() - start
+            _current_call.reset(token)
+            self.observe(call)
+
+    def observe(self, call):
+        labels = (("model", call.model), ("protocol", call.protocol))
+        with self._lock:
+            self._observe("llm_request_latency_seconds", labels, call.latency)
+            self._observe("llm_request_attempts", labels, call.attempts)
+            if call.ttfb is not None:
+                self._observe("llm_request_ttfb_seconds", labels, call.ttfb)
+            if call.queue_wait is not None:
+                self._observe("llm_request_queue_wait_seconds", labels, call.queue_wait)
+            if call.ttft is not None:
+                self._observe("llm_request_ttft_seconds", labels, call.ttft)
+            if call.reasoning_chars is not None:
+                self._observe("llm_reasoning_chars", labels, call.reasoning_chars)
+            if call.stopped_early:
+                self._inc("llm_stream_early_stops_total", labels)
+            self._inc("llm_requests_total", labels + (("status", call.status or "unknown"),))
+            for error in call.errors:
+                self._inc("llm_attempt_errors_total", labels + (("error", error),))
+            self._inc("llm_tokens_total", labels + (("kind", "prompt"),), call.prompt_tokens)
+            self._inc("llm_tokens_total", labels + (("kind", "completion"),), call.completion_tokens)
+
+    def _observe(self, name, labels, value):
+        key = (name, labels)
+        if key not in self._histograms:
+            self._histograms[key] = Histogram(self.HISTOGRAMS[name])
+        self._histograms[key].observe(value)
+
+    def _inc(self, name, labels, value=1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: 当前全部直方图和计数器的 JSON 快照。
+        """
+        with self._lock:
+            histograms = {}
+            for (name, labels), h in sorted(self._histograms.items()):
+                histograms.setdefault(name, []).append({
+                    "labels": dict(labels),
+                    "buckets": ["+Inf" if math.isinf(b) else b for b in h.buckets],
+                    "counts": list(h.counts),
+                    "sum": h.sum,
+                    "count": h.count,
+                    "p50": h.quantile(0.50),
+                    "p95": h.quantile(0.95),
+                    "p99": h.quantile(0.99),
+                })
+            counters = {}
+            for (name, labels), value in sorted(self._counters.items()):
+                counters.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        return {"timestamp": time.time(), "histograms": histograms, "counters": counters}
+
+    def to_prometheus(self):
+        """
+        Returns:
+            str: Prometheus 文本格式的全部指标。
+        """
+        def fmt(labels):
+            return ",".join(f'{k}="{str(v)}"' for k, v in labels)
+
+        lines = []
+        with self._lock:
+            seen = set()
+            for (name, labels), h in sorted(self._histograms.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                cumulative = 0
+                for upper, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    le = "+Inf" if math.isinf(upper) else repr(upper)
+                    lines.append(f'{name}_bucket{{{fmt(labels + (("le", le),))}}} {cumulative}')
+                lines.append(f"{name}_sum{{{fmt(labels)}}} {h.sum}")
+                lines.append(f"{name}_count{{{fmt(labels)}}} {h.count}")
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} counter")
+                    seen.add(name)
+                lines.append(f"{name}{{{fmt(labels)}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        """
+        把当前指标写入 export_dir 下的 metrics.prom 和 metrics.json，先写临时文件再替换。
+        """
+        os.makedirs(self.export_dir, exist_ok=True)
+        outputs = {
+            "metrics.prom": self.to_prometheus(),
+            "metrics.json": json.dumps(self.snapshot(), ensure_ascii=False, indent=2),
+        }
+        for filename, text in outputs.items():
+            path = os.path.join(self.export_dir, filename)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(path + ".tmp", path)
+
+    def start_exporter(self):
+        """
+        启动后台线程，每 interval 秒导出一次。重复调用无副作用。
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(self.interval):
+                try:
+                    self.export()
+                except OSError as e:
+                    print(f"遥测导出失败: {e}")
+
+        self._thread = threading.Thread(target=run, name="telemetry-exporter", daemon=True)
+        self._thread.start()
+
+    def stop_exporter(self):
+        """
+        停止后台导出线程并做最后一次导出。
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.export()
+
+    def summary(self, model_name, protocol_type):
+        """
+        Returns:
+            str: (模型, 协议) 的请求遥测摘要。
+        """
+        labels = (("model", model_name), ("protocol", protocol_type))
+
+        def quantiles(name):
+            h = self._histograms.get((name, labels))
+            if h is None or h.count == 0:
+                return "-"
+            return "/".join(f"{h.quantile(q):.2f}" for q in (0.50, 0.95, 0.99))
+
+        with self._lock:
+            statuses = {dict(l)["status"]: v for (n, l), v in self._counters.items()
+                        if n == "llm_requests_total" and l[:2] == labels}
+            errors = {dict(l)["error"]: v for (n, l), v in self._counters.items()
+                      if n == "llm_attempt_errors_total" and l[:2] == labels}
+            attempts = self._histograms.get(("llm_request_attempts", labels))
+            prompt_tokens = self._counters.get(("llm_tokens_total", labels + (("kind", "prompt"),)), 0)
+            completion_tokens = self._counters.get(("llm_tokens_total", labels + (("kind", "completion"),)), 0)
+            latency, ttfb, queue_wait = (quantiles("llm_request_latency_seconds"),
+                                         quantiles("llm_request_ttfb_seconds"),
+                                         quantiles("llm_request_queue_wait_seconds"))
+            ttft = quantiles("llm_request_ttft_seconds")
+            reasoning = self._histograms.get(("llm_reasoning_chars", labels))
+            early_stops = self._counters.get(("llm_stream_early_stops_total", labels), 0)
+
+        total = sum(statuses.values())
+        if total == 0:
+            return f"[{model_name} / {protocol_type}] 没有发送 API 请求"
+        mean_attempts = attempts.sum / attempts.count if attempts and attempts.count else 0
+        failed = sum(v for status, v in statuses.items() if status != "200")
+        error_str = ", ".join(f"{e}×{v}" for e, v in sorted(errors.items())) or "无"
+        text = (f"[{model_name} / {protocol_type}] 请求 {total} 次，失败 {failed} 次，平均尝试 {mean_attempts:.2f} 次，"
+                f"失败尝试: {error_str}\n"
+                f"  延迟 p50/p95/p99 = {latency} s，首字节 = {ttfb} s，排队 = {queue_wait} s，"
+                f"token 输入 {prompt_tokens} / 输出 {completion_tokens}")
+        if ttft != "-":
+            mean_reasoning = reasoning.sum / reasoning.count if reasoning and reasoning.count else 0
+            text += (f"\n  流式：首 token = {ttft} s，平均推理 {mean_reasoning:.0f} 字符，"
+                     f"解析到答案后提前结束 {early_stops} 次")
+        return text
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+from openai import OpenAI
+
+# 仓库中的模块都是顶层脚本，测试直接从仓库根目录导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pipeline 在导入时读取 API 密钥，测试只向本地的模拟服务发送请求，给一个占位值即可
+os.environ.setdefault("serverless_api", "test")
+
+
+@pytest.fixture
+def start_fake_server(monkeypatch):
+    """
+    返回一个函数，每次调用在本进程中启动一个新的模拟服务（空闲端口、固定的短延迟、不注入错误），
+    并把 pipeline 的同步和异步客户端指向它。默认关闭响应缓存，需要缓存的测试自行设置 pipeline.response_cache。
+    测试结束时关闭所有服务。
+    """
+    import fake_llm_server
+    import pipeline
+
+    for name, value in (("latency", "fixed"), ("latency_mean", 0.01), ("error_rate", 0.0), ("rate_limit_rate", 0.0)):
+        monkeypatch.setattr(fake_llm_server, name, value)
+    monkeypatch.setattr(pipeline, "cache_mode", "off")
+    monkeypatch.setattr(pipeline, "response_cache", None)
+    servers = []
+
+    def start():
+        server = fake_llm_server.start_server(("127.0.0.1", 0))
+        servers.append(server)
+        base_url = f"http://127.0.0.1:{server.server_port}/v1"
+        monkeypatch.setattr(pipeline, "serverless_url", base_url)
+        monkeypatch.setattr(pipeline, "client", OpenAI(base_url=base_url, api_key="test", max_retries=0,
+                                                       http_client=pipeline._http_client()))
+        pipeline._init_runtime()  # 直接调用 my_request 等函数的测试也需要遥测和 token 账本
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,64 @@
+import pytest
+
+from answer_extraction import AnswerExtractor, StreamingAnswerParser, extract_label
+
+TEXTS = [
+    'The best answer is: "(B) a river"',
+    'Looking at (A) and (C), the best answer is: "(C) a cup"',
+    'The best answer is: "(A) first". Wait, the best answer is: "(D) second"',
+    'The best answer is: "(A) first" and after a long explanation that goes on for quite a while, '
+    'the best answer is: "(E) final"',
+    '(B) seems right, but (C) is also possible.',
+    '<think>The best answer is (A)? Maybe (B).</think>The best answer is: "(E) none"',
+    '<think>reasoning only, never closed',
+    'ANSWER IS (c). The Answer Is (D) then.',
+    'I would pick B. because it fits.',
+    'no label at all',
+]
+
+
+def _stream(text, chunk_size, grace_chars=32):
+    parser = StreamingAnswerParser(grace_chars)
+    for i in range(0, len(text), chunk_size):
+        if parser.feed(text[i:i + chunk_size]):
+            break
+    return parser
+
+
+def test_lowercase_labels_are_not_answers():
+    assert extract_label('The best answer is: "(a) a river"') == ""
+    assert extract_label("Maybe (b) is right") == ""
+    assert extract_label('THE BEST ANSWER IS: "(B) a river"') == "B"
+
+
+@pytest.mark.parametrize("text", TEXTS)
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1000])
+def test_streaming_label_matches_batch_extraction(text, chunk_size):
+    extractor = AnswerExtractor()
+    parser = _stream(text, chunk_size)
+    label, name = extractor.match(parser.content)
+    # 流式解析只使用严格的模式，宽松模式的结果需要读完回答后由批量提取得到
+    assert parser.label == (label if name in ("answer_statement", "label_in_parens") else "")
+    if not parser.done():
+        assert parser.content == text
+
+
+def test_streaming_takes_last_statement_within_grace_window():
+    text = 'The best answer is: "(A) first". Wait, the best answer is: "(D) second" and some trailing text here.'
+    parser = _stream(text, 4, grace_chars=64)
+    assert parser.label == "D" == extract_label(text)
+
+
+def test_streaming_does_not_stop_on_parenthesized_label():
+    text = "(A) looks plausible. " + "x" * 100 + ' In the end the best answer is: "(C) cup"'
+    parser = _stream(text, 5)
+    assert parser.content == text
+    assert parser.label == "C" == extract_label(text)
+
+
+def test_streaming_stops_after_statement_and_grace():
+    text = 'The best answer is: "(B) a river" ' + "y" * 500
+    parser = _stream(text, 8)
+    assert parser.done()
+    assert len(parser.content) < len(text)
+    assert parser.label == "B" == extract_label(parser.content)
@@ -0,0 +1,44 @@
+import json
+import os
+
+import pipeline
+
+
+def _read_outputs(directory):
+    outputs = {}
+    for name in sorted(os.listdir(directory)):
+        if name.startswith("CommonSense_results_"):
+            with open(os.path.join(directory, name), "rb") as f:
+                outputs[name] = f.read()
+    return outputs
+
+
+def test_async_run_matches_thread_run(tmp_path, monkeypatch, start_fake_server):
+    monkeypatch.chdir(tmp_path)
+    for name, value in (("method", ""), ("use_result_store", False), ("resume", False),
+                        ("num_shards", 1), ("stream_mode", False), ("scoring_mode", "generate")):
+        monkeypatch.setattr(pipeline, name, value)
+    dataset = [{"id": f"q{i:03d}", "question": f"Question {i}?",
+                "choices": [{"label": label, "text": f"{label} {i}"} for label in "ABCDE"],
+                "answerKey": "ABCDE"[i % 5]} for i in range(12)]
+    with open("CommonSense.json", "w", encoding="utf-8") as f:
+        json.dump(dataset, f)
+    data_length = len(dataset)
+
+    # 每次运行使用新的模拟服务，相同请求第一次收到时的回答相同
+    start_fake_server()
+    thread_results = pipeline.main_experiment("CommonSense.json", "model", data_length=data_length, num_workers=4)
+    thread_outputs = _read_outputs(os.path.join("output", "model"))
+    os.rename("output", "output-thread")
+
+    start_fake_server()
+    async_results = pipeline.main_experiment_async("CommonSense.json", "model", data_length=data_length,
+                                                   max_concurrency=8)
+    async_outputs = _read_outputs(os.path.join("output", "model"))
+
+    assert set(async_results) == set(pipeline._protocols_to_run())
+    assert all(len(items) == data_length for items in async_results.values())
+    assert {protocol: [item["protocol_result"] for item in items] for protocol, items in async_results.items()} == \
+        {protocol: [item["protocol_result"] for item in items] for protocol, items in thread_results.items()}
+    assert len(async_outputs) == 3 * len(pipeline._protocols_to_run())  # .pkl、.json 和 .status.json
+    assert async_outputs == thread_outputs
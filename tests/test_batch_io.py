@@ -0,0 +1,108 @@
+import json
+import os
+import random
+
+import pytest
+
+import pipeline
+from batch_io import (_fake_answer, make_batch_request, make_custom_id, parse_custom_id, read_batch_output,
+                      write_batch_input, write_fake_batch_output)
+
+IDS = [f"q{i:03d}" for i in range(12)]
+
+
+def test_custom_id_round_trip():
+    assert make_custom_id("q001", "Trust", "self-consistency", 3) == "q001|Trust|self-consistency|3"
+    assert parse_custom_id(make_custom_id("q001", "Raw", "")) == ("q001", "Raw", "", 0)
+    # 问题 id 本身含有 "|" 时也能还原
+    assert parse_custom_id(make_custom_id("a|b", "Doubt", "cot", 2)) == ("a|b", "Doubt", "cot", 2)
+
+
+def test_read_batch_output_marks_failed_requests(tmp_path):
+    input_path = str(tmp_path / "in.jsonl")
+    output_path = str(tmp_path / "out.jsonl")
+    body = {"model": "model", "messages": [{"role": "user", "content": "Pick one: (A) x (B) y"}]}
+    custom_ids = [make_custom_id(qa_id, "Trust", "", 0) for qa_id in IDS]
+    assert write_batch_input(input_path, (make_batch_request(cid, body) for cid in custom_ids)) == len(IDS)
+    assert write_fake_batch_output(input_path, output_path, error_rate=0.5) == len(IDS)
+
+    outputs = read_batch_output(output_path)
+    assert sorted(outputs) == sorted(custom_ids)
+    failed = [cid for cid, content in outputs.items() if content is None]
+    assert 0 < len(failed) < len(IDS)
+    for cid, content in outputs.items():
+        if content is not None:
+            assert content == _fake_answer(cid, body)
+
+
+@pytest.fixture
+def batch_dataset(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ("client", "response_cache", "result_store", "request_telemetry", "token_ledger", "_vote_executor"):
+        monkeypatch.setattr(pipeline, name, None)
+    for name, value in (("cache_mode", "readwrite"), ("use_result_store", False), ("scoring_mode", "generate"),
+                        ("vote_num", 3), ("num_shards", 1), ("shard_index", 0)):
+        monkeypatch.setattr(pipeline, name, value)
+    dataset = [{"id": qa_id, "question": f"Question {qa_id}?",
+                "choices": [{"label": label, "text": f"{label} {qa_id}"} for label in "ABCDE"],
+                "answerKey": "ABCDE"[i % 5]} for i, qa_id in enumerate(IDS)]
+    with open("CommonSense.json", "w", encoding="utf-8") as f:
+        json.dump(dataset, f)
+    return "CommonSense.json", len(dataset)
+
+
+def _shuffle_lines(path, seed):
+    with open(path, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    random.Random(seed).shuffle(lines)
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+
+
+@pytest.mark.parametrize("method", ["", "self-consistency"])
+def test_export_import_round_trip(batch_dataset, monkeypatch, method):
+    data_file, data_length = batch_dataset
+    monkeypatch.setattr(pipeline, "method", method)
+    paths = pipeline.export_batch(data_file, "model", data_length)
+    assert sorted(paths) == sorted(pipeline._protocols_to_run())
+
+    bodies = {}
+    for protocol_type, input_path in paths.items():
+        with open(input_path, "r", encoding="utf-8") as f:
+            for line in f:
+                request = json.loads(line)
+                bodies[request["custom_id"]] = request["body"]
+        output_path = pipeline._batch_path("model", protocol_type, data_length, "output")
+        write_fake_batch_output(input_path, output_path)
+        _shuffle_lines(output_path, seed=len(protocol_type))  # 批处理输出的顺序与输入无关
+    num_votes = 3 if method else 1
+    assert len(bodies) == len(paths) * len(IDS) * num_votes
+
+    results = pipeline.import_batch(data_file, "model", data_length)
+    assert sorted(results) == sorted(paths)
+    for protocol_type, entries in results.items():
+        protocol_method = "" if protocol_type == "Raw" else method
+        assert [entry["id"] for entry in entries] == IDS
+        for entry in entries:
+            custom_ids = [make_custom_id(entry["id"], protocol_type, protocol_method, vote) for vote in range(num_votes)]
+            answers = [_fake_answer(cid, bodies[cid]) for cid in custom_ids]
+            # 每个回答都按 custom_id 对应回自己的问题和投票
+            assert entry["protocol_result"] == "\n".join(answers)
+            if method:
+                assert entry["votes_used"] == num_votes
+            # 导入的回答写入响应缓存，键与在线请求相同
+            messages = bodies[custom_ids[0]]["messages"]
+            for vote, answer in enumerate(answers):
+                assert pipeline.response_cache.get(pipeline._cache_key(messages, "model", vote)) == answer
+        result_file = os.path.join("output", "model",
+                                   f"CommonSense_results_{len(IDS)}{method}_{protocol_type}.json")
+        assert os.path.exists(result_file)
+
+
+def test_import_refuses_a_changed_prompt_table(batch_dataset, monkeypatch):
+    data_file, data_length = batch_dataset
+    monkeypatch.setattr(pipeline, "method", "")
+    pipeline.export_batch(data_file, "model", data_length)
+    monkeypatch.setattr(pipeline, "random_seed", pipeline.random_seed + 1)
+    with pytest.raises(ValueError):
+        pipeline.import_batch(data_file, "model", data_length)
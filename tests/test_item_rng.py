@@ -0,0 +1,68 @@
+import concurrent.futures
+import random
+
+import pytest
+
+import pipeline
+
+
+def _dataset(n=30):
+    return [{
+        "id": f"q{i}",
+        "question": f"Question {i}?",
+        "choices": [{"label": label, "text": f"option {label}{i}"} for label in "ABCDE"],
+        "answerKey": "ABCDE"[i % 5],
+    } for i in range(n)]
+
+
+@pytest.fixture(autouse=True)
+def seed(monkeypatch):
+    monkeypatch.setattr(pipeline, "random_seed", 42)
+
+
+def test_item_rng_is_pinned_and_depends_on_every_input(monkeypatch):
+    # 派生方式改变会让已有的提示表、响应缓存和结果日志全部失效，这里固定两个已知的值
+    assert pipeline._item_rng("q0", "Trust").getrandbits(32) == 4231206928
+    assert pipeline._item_rng("q0", "Trust", "self-consistency", 2).getrandbits(32) == 1206419313
+
+    first = pipeline._item_rng("q0", "Trust", "cot", 1).getrandbits(64)
+    random.seed(0)  # 与全局随机状态无关
+    assert pipeline._item_rng("q0", "Trust", "cot", 1).getrandbits(64) == first
+    variants = [("q1", "Trust", "cot", 1), ("q0", "Doubt", "cot", 1), ("q0", "Trust", "", 1),
+                ("q0", "Trust", "cot", 0)]
+    assert all(pipeline._item_rng(*args).getrandbits(64) != first for args in variants)
+    monkeypatch.setattr(pipeline, "random_seed", 43)
+    assert pipeline._item_rng("q0", "Trust", "cot", 1).getrandbits(64) != first
+
+
+def _build(qa_item, protocol_type, dataset):
+    return pipeline.build_protocol_messages(qa_item.copy(), protocol_type, "", dataset)
+
+
+@pytest.mark.parametrize("protocol_type", ["Wrong_Guidance", "Trust", "Doubt"])
+def test_prompts_do_not_depend_on_order_or_threads(protocol_type):
+    dataset = _dataset()
+    in_order = {qa_item["id"]: _build(qa_item, protocol_type, dataset) for qa_item in dataset}
+
+    # 打乱顺序、多线程并发构造，期间其他代码使用全局随机数
+    shuffled = random.Random(7).sample(dataset, len(dataset))
+
+    def build(qa_item):
+        random.random()
+        return qa_item["id"], _build(qa_item, protocol_type, dataset)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        concurrent_results = dict(executor.map(build, shuffled))
+    assert concurrent_results == in_order
+    # 只构造一部分问题（分片或从中断处继续）时，每个问题的提示不变
+    assert {q["id"]: _build(q, protocol_type, dataset) for q in shuffled[:5]} == \
+        {q["id"]: in_order[q["id"]] for q in shuffled[:5]}
+    # 随机选择确实因问题而异
+    assert len({str(messages) for messages in in_order.values()}) == len(dataset)
+
+
+def test_prompts_change_with_the_seed(monkeypatch):
+    dataset = _dataset()
+    before = _build(dataset[0], "Trust", dataset)
+    monkeypatch.setattr(pipeline, "random_seed", 43)
+    assert _build(dataset[0], "Trust", dataset) != before
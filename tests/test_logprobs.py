@@ -0,0 +1,77 @@
+import math
+from types import SimpleNamespace
+
+import pytest
+
+import fake_llm_server
+import pipeline
+from answer_extraction import argmax_label, label_distribution
+from retry_policy import FatalRequestError, RetryPolicy, classify_error
+
+QA_ITEM = {"id": "q000", "question": "Where do fish live?",
+           "choices": [{"label": label, "text": text} for label, text in
+                       zip("ABCDE", ["a river", "a tree", "a car", "a cloud", "a desk"])],
+           "answerKey": "A"}
+
+
+def _response(top_logprobs, content="A"):
+    tokens = None
+    if top_logprobs is not None:
+        top = [SimpleNamespace(token=token, logprob=logprob) for token, logprob in top_logprobs]
+        tokens = [SimpleNamespace(token=content, logprob=top_logprobs[0][1] if top_logprobs else 0.0,
+                                  top_logprobs=top)]
+    choice = SimpleNamespace(message=SimpleNamespace(content=content),
+                             logprobs=None if tokens is None else SimpleNamespace(content=tokens))
+    return SimpleNamespace(choices=[choice])
+
+
+def test_label_distribution_merges_spellings():
+    probs, mass = label_distribution([("B", math.log(0.4)), (" B", math.log(0.1)), ("(A", math.log(0.2)),
+                                      ("a", math.log(0.1)), ("The", math.log(0.2))])
+    assert list(probs) == ["A", "B"]
+    assert probs["B"] == pytest.approx(0.5 / 0.7)
+    assert probs["A"] == pytest.approx(0.2 / 0.7)
+    assert mass == pytest.approx(0.7)
+    assert argmax_label(probs) == "B"
+    assert label_distribution([("The", 0.0)]) == ({}, 0.0)
+    assert argmax_label({}) == ""
+
+
+def test_parse_logprob_response():
+    scored = pipeline._parse_logprob_response(_response([("C", math.log(0.6)), ("D", math.log(0.3))], content="C"))
+    assert scored["content"] == "C"
+    assert scored["label_probs"] == pytest.approx({"C": 2 / 3, "D": 1 / 3})
+    assert scored["label_mass"] == pytest.approx(0.9)
+
+
+def test_missing_logprobs_is_fatal():
+    with pytest.raises(FatalRequestError) as excinfo:
+        pipeline._parse_logprob_response(_response(None))
+    assert classify_error(excinfo.value) == "fatal"
+
+    calls = []
+
+    def attempt():
+        calls.append(1)
+        return pipeline._parse_logprob_response(_response(None))
+
+    with pytest.raises(FatalRequestError):
+        RetryPolicy(max_delay=0.0).call(attempt, max_retries=5, base_delay=0.0)
+    assert len(calls) == 1
+
+
+def test_score_labels_against_fake_server(monkeypatch, start_fake_server):
+    start_fake_server()
+    messages = pipeline._logprob_messages(pipeline.build_protocol_messages(QA_ITEM, "Raw"))
+    scored = pipeline.score_labels(messages, "model", max_retries=1)
+
+    tokens = fake_llm_server.make_label_logprobs("model", messages)
+    expected_probs, expected_mass = label_distribution(tokens)
+    assert scored["content"] == tokens[0][0]
+    assert scored["label_probs"] == pytest.approx(expected_probs)
+    assert scored["label_mass"] == pytest.approx(expected_mass)
+    assert argmax_label(scored["label_probs"]) == tokens[0][0].strip()
+
+    result = pipeline._logprob_result(scored, messages)
+    assert result[0] == tokens[0][0].strip()
+    assert result[2]["label_probs"] == scored["label_probs"]
@@ -0,0 +1,136 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import metrics_engine
+from result_store import ResultStore
+from result_writer import status_path
+
+INCOMPLETE = {"processed_questions": 2, "expected_questions": 4, "budget_exhausted": True, "complete": False}
+
+
+def _write_results(directory, name, items, status=None):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(items, f)
+    if status is not None:
+        with open(status_path(path), "w", encoding="utf-8") as f:
+            json.dump(status, f)
+    return path
+
+
+def _items(n):
+    return [{"id": f"q{i}", "model_ans": "A", "correct_ans": "A"} for i in range(n)]
+
+
+def test_incomplete_json_results_are_refused(tmp_path):
+    model_dir = str(tmp_path / "model")
+    _write_results(model_dir, "CommonSense_results_4_Raw.json", _items(4), dict(INCOMPLETE, complete=True))
+    _write_results(model_dir, "CommonSense_results_2_Trust.json", _items(2), INCOMPLETE)
+
+    loader = metrics_engine.ResultLoader(str(tmp_path))
+    assert len(loader("model", 4, "", "Raw")) == 4
+    with pytest.raises(ValueError):
+        loader("model", 2, "", "Trust")
+
+
+def test_incomplete_results_are_marked_when_allowed(tmp_path):
+    model_dir = str(tmp_path / "model")
+    _write_results(model_dir, "CommonSense_results_2_Trust.json", _items(2), INCOMPLETE)
+    _write_results(model_dir, "CommonSense_results_2_Doubt.json", _items(2))
+
+    loader = metrics_engine.ResultLoader(str(tmp_path), allow_incomplete=True)
+    assert loader("model", 2, "", "Trust").status == INCOMPLETE
+    assert loader("model", 2, "", "Doubt").status is None
+
+
+def test_incomplete_store_partitions_are_refused(tmp_path):
+    store = ResultStore(str(tmp_path / "store"))
+    store.write_questions([{"id": "q0", "question": "?", "choices": [], "answerKey": "A"},
+                           {"id": "q1", "question": "?", "choices": [], "answerKey": "B"}])
+    items = [{"id": "q0", "protocol_result": "(A)", "model_ans": "A"},
+             {"id": "q1", "protocol_result": "(B)", "model_ans": "B"}]
+    store.write_results("model", "", "Trust", items, status=INCOMPLETE)
+    store.write_results("model", "", "Doubt", items)
+    assert store.read_status("model", 2, "", "Trust") == INCOMPLETE
+    assert store.read_status("model", 2, "", "Doubt") is None
+
+    with pytest.raises(ValueError):
+        metrics_engine.ResultLoader(store=store)("model", 2, "", "Trust")
+    assert len(metrics_engine.ResultLoader(store=store)("model", 2, "", "Doubt")) == 2
+
+
+def _naive_bootstrap(numerators, denominators, resamples, confidence, seed):
+    # 逐次重抽样的直接实现，与 bootstrap_ratios 使用相同的随机数序列
+    rng = np.random.default_rng(seed)
+    stats = []
+    for _ in range(resamples):
+        picks = rng.integers(0, numerators.shape[1], size=numerators.shape[1])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stats.append(numerators[:, picks].sum(axis=1) / denominators[:, picks].sum(axis=1) * 100)
+    alpha = (1 - confidence) / 2 * 100
+    return np.nanpercentile(np.array(stats), [alpha, 100 - alpha], axis=0).T
+
+
+def test_bootstrap_ratios_match_a_naive_bootstrap():
+    rng = np.random.default_rng(1)
+    denominators = (rng.random((3, 50)) < 0.6).astype(float)
+    denominators[2, 2:] = 0  # 很多重抽样中分母为 0，这些结果不参与计算
+    numerators = denominators * (rng.random((3, 50)) < 0.5)
+    expected = _naive_bootstrap(numerators, denominators, 700, 0.9, seed=3)
+    for chunk in (700, 256):
+        intervals = metrics_engine.bootstrap_ratios(numerators, denominators, 700, chunk, 0.9, seed=3)
+        np.testing.assert_allclose(intervals, expected, atol=1e-3)
+    assert (intervals[:, 0] <= intervals[:, 1]).all()
+
+
+def test_mcnemar_exact_and_chi2():
+    def correct(pairs):
+        return np.array([a for a, _ in pairs]), np.array([b for _, b in pairs])
+
+    same = correct([(True, True)] * 5 + [(False, False)] * 3)
+    assert metrics_engine.mcnemar_test(*same)["p_value"] == 1.0
+
+    # 1 个只有 A 正确、5 个只有 B 正确：p = 2 * (C(6,0) + C(6,1)) / 2^6
+    test = metrics_engine.mcnemar_test(*correct([(True, False)] + [(False, True)] * 5 + [(True, True)] * 4))
+    assert (test["questions"], test["a_only"], test["b_only"], test["test"]) == (10, 1, 5, "exact")
+    assert test["p_value"] == pytest.approx(14 / 64)
+
+    test = metrics_engine.mcnemar_test(*correct([(True, False)] * 30 + [(False, True)] * 10))
+    assert test["test"] == "chi2"
+    assert test["statistic"] == pytest.approx(19 ** 2 / 40)
+    assert test["p_value"] == pytest.approx(0.002663, abs=1e-5)
+    assert metrics_engine.mcnemar_test(*correct([(True, False)] * 30 + [(False, True)] * 10),
+                                       exact_limit=40)["test"] == "exact"
+
+
+def test_significance_pairs_methods_on_shared_questions(tmp_path):
+    model_dir = str(tmp_path / "model")
+    raw = [{"id": f"q{i}", "model_ans": "A", "correct_ans": "A"} for i in range(20)]
+    # cot 只有 q0-q14 的结果；q0-q9 两种方法都正确，q10-q14 只有 cot 正确，q15-q19 只有 none 有结果
+    trust_none = [{"id": f"q{i}", "model_ans": "A" if i < 10 else "B", "correct_ans": "A"} for i in range(20)]
+    trust_cot = [{"id": f"q{i}", "model_ans": "A", "correct_ans": "A"} for i in range(15)]
+    _write_results(model_dir, "CommonSense_results_20_Raw.json", raw)
+    _write_results(model_dir, "CommonSense_results_20_Trust.json", trust_none)
+    _write_results(model_dir, "CommonSense_results_20cot_Trust.json", trust_cot)
+
+    def run(seed):
+        return metrics_engine.significance_all(methods=["", "cot"], data_length=20,
+                                               loader=metrics_engine.ResultLoader(str(tmp_path)),
+                                               resamples=500, chunk=128, seed=seed)
+
+    significance = run(seed=0)
+    assert significance == run(seed=0)
+    assert significance["bootstrap"][""]["model"]["Raw"]["accuracy"] == [100.0, 100.0]
+    low, high = significance["bootstrap"][""]["model"]["Trust"]["accuracy"]
+    assert low < 50.0 < high
+    assert significance["bootstrap"]["cot"]["model"]["Trust"]["accuracy"] == [100.0, 100.0]
+    assert significance["bootstrap"]["cot"]["model"]["Trust"]["independence_rate"] == "N/A"
+
+    [test] = significance["mcnemar"]["model"]["Trust"]
+    assert (test["method_a"], test["method_b"]) == ("none", "cot")
+    assert (test["questions"], test["a_only"], test["b_only"]) == (15, 0, 5)
+    assert test["p_value"] == pytest.approx(2 / 32)
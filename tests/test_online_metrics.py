@@ -0,0 +1,84 @@
+import json
+import os
+
+import pytest
+
+import pipeline
+from online_metrics import OnlineMetrics, wilson_interval
+from result_writer import read_status
+
+GOLD = {f"q{i}": "A" for i in range(6)}
+# q0-q2 的 Raw 回答正确，q3-q5 错误
+RAW = {"q0": "A", "q1": "A", "q2": "A", "q3": "B", "q4": "C", "q5": "N/A"}
+
+
+def test_wilson_interval():
+    assert wilson_interval(0, 0) == (0.0, 1.0)
+    low, high = wilson_interval(5, 10)
+    assert low == pytest.approx(0.2366, abs=1e-4)
+    assert high == pytest.approx(0.7634, abs=1e-4)
+    low, high = wilson_interval(0, 10)
+    assert low == 0.0 and high == pytest.approx(0.2775, abs=1e-4)
+    assert wilson_interval(10, 10)[1] == 1.0
+
+
+def test_conformity_follows_the_raw_reference():
+    trust = OnlineMetrics("Trust", GOLD, RAW)
+    doubt = OnlineMetrics("Doubt", GOLD, RAW)
+    for q_id, answer in (("q0", "B"), ("q1", "A"), ("q2", "N/A"), ("q3", "A"), ("q4", "D"), ("q5", "A")):
+        trust.observe({"id": q_id, "model_ans": answer})
+        doubt.observe({"id": q_id, "model_ans": answer})
+    # Trust：Raw 正确的 q0、q1 计入（q2 回答为 N/A），q0 改错
+    assert (trust.conformity_count, trust.conformity_total) == (1, 2)
+    # Doubt：Raw 错误的 q3、q4 计入（q5 的 Raw 为 N/A），q3 改对
+    assert (doubt.conformity_count, doubt.conformity_total) == (1, 2)
+    assert trust.snapshot()["accuracy"] == pytest.approx(100 * 3 / 6)
+    assert OnlineMetrics("Raw", GOLD, RAW).snapshot()["conformity_rate"] == "N/A"
+
+
+def test_set_reference_recounts_observed_answers():
+    late = OnlineMetrics("Trust", GOLD)
+    fresh = OnlineMetrics("Trust", GOLD, RAW)
+    for q_id, answer in (("q0", "B"), ("q1", "A"), ("q3", "A")):
+        late.observe({"id": q_id, "model_ans": answer})
+        fresh.observe({"id": q_id, "model_ans": answer})
+    assert not late.has_conformity()
+    late.set_reference(RAW)
+    assert late.snapshot() == fresh.snapshot()
+
+
+def test_should_stop_waits_for_min_questions():
+    tracker = OnlineMetrics("Doubt", GOLD, RAW, target_width=100, min_questions=2)
+    tracker.observe({"id": "q3", "model_ans": "A"})
+    assert not tracker.should_stop()
+    tracker.observe({"id": "q4", "model_ans": "A"})
+    assert tracker.should_stop() and tracker.snapshot()["stopped_early"]
+    assert not OnlineMetrics("Raw", GOLD, RAW, target_width=100, min_questions=0).should_stop()
+
+
+def test_async_run_stops_protocols_early(tmp_path, monkeypatch, start_fake_server):
+    monkeypatch.chdir(tmp_path)
+    for name, value in (("method", ""), ("use_result_store", False), ("num_shards", 1),
+                        ("online_metrics", True), ("early_stop_width", 100), ("early_stop_min_questions", 3)):
+        monkeypatch.setattr(pipeline, name, value)
+    dataset = [{"id": f"q{i:03d}", "question": f"Question {i}?",
+                "choices": [{"label": label, "text": f"{label} {i}"} for label in "ABCDE"],
+                "answerKey": "ABCDE"[i % 5]} for i in range(40)]
+    with open("CommonSense.json", "w", encoding="utf-8") as f:
+        json.dump(dataset, f)
+    start_fake_server()
+    results = pipeline.main_experiment_async("CommonSense.json", "model", data_length=40, max_concurrency=2)
+
+    # Raw 是参照，总是完整运行；Correct_Guidance 在 Raw 完成后才出队，必然提前停止
+    assert len(results["Raw"]) == 40
+    processed = len(results["Correct_Guidance"])
+    assert 0 < processed < 40
+    # 结果文件名中的数量是实际保存的问题数
+    status = read_status(os.path.join("output", "model", f"CommonSense_results_{processed}_Correct_Guidance.json"))
+    assert status["stopped_early"] and not status["complete"]
+
+    with open(pipeline._online_metrics_path("model", 40), encoding="utf-8") as f:
+        online = json.load(f)
+    assert set(online) == set(pipeline._protocols_to_run())
+    assert online["Correct_Guidance"]["stopped_early"] and online["Correct_Guidance"]["conformity_rate"] != "N/A"
+    assert online["Raw"]["complete"] and online["Raw"]["total_questions"] == 40
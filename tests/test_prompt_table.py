@@ -0,0 +1,74 @@
+import gzip
+import json
+
+import pytest
+
+import pipeline
+from prompt_table import iter_prompt_table, load_prompt_table, read_fingerprint, write_prompt_table
+
+
+def _dataset(n=8):
+    return [{
+        "id": f"q{i}",
+        "question": f"Question {i}?",
+        "choices": [{"label": label, "text": f"option {label}{i}"} for label in "ABCDE"],
+        "answerKey": "ABCDE"[i % 5],
+    } for i in range(n)]
+
+
+def _rows():
+    return [{"id": "q0", "protocol": "Raw", "method": "", "messages": [{"role": "user", "content": "hi"}]},
+            {"id": "q1", "protocol": "Trust", "method": "", "messages": None}]
+
+
+def test_fingerprint_round_trip_and_rows_skip_header(tmp_path):
+    path = str(tmp_path / "table.jsonl.gz")
+    assert write_prompt_table(path, _rows(), fingerprint={"random_seed": 42}) == 2
+    assert read_fingerprint(path) == {"random_seed": 42}
+    assert [row["id"] for row in iter_prompt_table(path)] == ["q0", "q1"]
+    assert load_prompt_table(path, "Raw") == {"q0": [{"role": "user", "content": "hi"}]}
+
+
+def test_table_without_fingerprint(tmp_path):
+    path = str(tmp_path / "table.jsonl.gz")
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for row in _rows():
+            f.write(json.dumps(row) + "\n")
+    assert read_fingerprint(path) is None
+    assert len(list(iter_prompt_table(path))) == 2
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pipeline, "method", "")
+    monkeypatch.setattr(pipeline, "random_seed", 42)
+    return tmp_path
+
+
+def test_prompt_table_is_reused_when_fingerprint_matches(workdir):
+    dataset = _dataset()
+    path = pipeline._ensure_prompt_table(dataset, len(dataset))
+    assert pipeline._fingerprint_mismatch(path, dataset) == []
+    with open(path, "rb") as f:
+        before = f.read()
+    assert pipeline._ensure_prompt_table(dataset, len(dataset)) == path
+    with open(path, "rb") as f:
+        assert f.read() == before
+
+
+@pytest.mark.parametrize("change", ["random_seed", "PROMPT_SCHEMA_VERSION", "dataset"])
+def test_prompt_table_is_rebuilt_when_inputs_change(workdir, monkeypatch, change):
+    dataset = _dataset()
+    path = pipeline._ensure_prompt_table(dataset, len(dataset))
+    if change == "dataset":
+        dataset = dataset[::-1]
+    else:
+        monkeypatch.setattr(pipeline, change, getattr(pipeline, change) + 1)
+    expected = {"random_seed": "random_seed", "PROMPT_SCHEMA_VERSION": "schema_version",
+                "dataset": "dataset_sha256"}[change]
+    assert pipeline._fingerprint_mismatch(path, dataset) == [expected]
+
+    pipeline._ensure_prompt_table(dataset, len(dataset))
+    assert pipeline._fingerprint_mismatch(path, dataset) == []
+    assert read_fingerprint(path) == pipeline._prompt_fingerprint(dataset)
@@ -0,0 +1,67 @@
+import os
+
+import pipeline
+from response_cache import ResponseCache
+
+MESSAGES = [{"role": "user", "content": "Where do fish live?"}]
+QA_ITEM = {"id": "q000", "question": "Where do fish live?",
+           "choices": [{"label": label, "text": text} for label, text in
+                       zip("ABCDE", ["a river", "a tree", "a car", "a cloud", "a desk"])],
+           "answerKey": "A"}
+
+
+def test_key_is_stable():
+    # 键的计算方式改变会让已有的缓存全部失效，这里固定一个已知的键
+    key = ResponseCache.make_key("model", MESSAGES, 512, 0.7, 0.9, 50, 0)
+    assert key == "2daf59054e3680bc7d36d6d62a78b2a87199564b11d6686bd59f9496429402c0"
+    assert ResponseCache.make_key("model", MESSAGES, 512, 0.7, 0.9, 50, 0, extra=None) == key
+    reordered = [{"content": "Where do fish live?", "role": "user"}]
+    assert ResponseCache.make_key("model", reordered, 512, 0.7, 0.9, 50, 0) == key
+    assert ResponseCache.make_key("model", MESSAGES, 512, 0.7, 0.9, 50, 1) != key
+    assert ResponseCache.make_key("model", MESSAGES, 512, 0.7, 0.9, 50, 0, extra={"n": 1}) != key
+    assert pipeline._cache_key(MESSAGES, "model", 0) == pipeline._cache_key(list(MESSAGES), "model", 0)
+
+
+def test_put_get_and_read_only(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    key = ResponseCache.make_key("model", MESSAGES, 512, 0.7, 0.9, 50, 0)
+    assert cache.get(key) is None
+    cache.put(key, "The best answer is: \"(A) a river\"")
+    cache.put(ResponseCache.make_key("model", MESSAGES, 512, 0.7, 0.9, 50, 1), None)  # 失败的请求不缓存
+    assert cache.get(key) == "The best answer is: \"(A) a river\""
+    assert (cache.hits, cache.misses, cache.writes) == (1, 1, 1)
+
+    replay = ResponseCache(str(tmp_path), read_only=True)
+    replay.put(ResponseCache.make_key("other", MESSAGES, 512, 0.7, 0.9, 50, 0), "x")
+    assert replay.get(key) == "The best answer is: \"(A) a river\""
+    assert replay.writes == 0
+    assert sum(len(files) for _, _, files in os.walk(tmp_path)) == 1
+
+
+def test_eviction_removes_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=10 ** 6)
+    keys = [ResponseCache.make_key("model", MESSAGES, 512, 0.7, 0.9, 50, i) for i in range(4)]
+    for i, key in enumerate(keys):
+        cache.put(key, "x" * 100)
+        os.utime(cache._path(key), (1000 + i, 1000 + i))
+    cache.get(keys[0])  # 读取更新访问时间，最久未使用的变为 keys[1]
+
+    cache.max_bytes = 400  # 每个条目 116 字节，写入第五条后淘汰到 360 字节以下
+    cache.put(ResponseCache.make_key("model", MESSAGES, 512, 0.7, 0.9, 50, 9), "x" * 100)
+    assert cache.evictions == 2
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None and cache.get(keys[2]) is None
+
+
+def test_replay_sends_no_requests(tmp_path, monkeypatch, start_fake_server):
+    messages = pipeline.build_protocol_messages(QA_ITEM, "Raw")
+    monkeypatch.setattr(pipeline, "method", "")
+    monkeypatch.setattr(pipeline, "response_cache", ResponseCache(str(tmp_path)))
+    start_fake_server()
+    recorded = [pipeline.my_request(messages, "model", max_retries=1, sample_index=i) for i in range(2)]
+
+    monkeypatch.setattr(pipeline, "response_cache", ResponseCache(str(tmp_path), read_only=True))
+    server = start_fake_server()
+    assert [pipeline.my_request(messages, "model", max_retries=1, sample_index=i) for i in range(2)] == recorded
+    assert pipeline.my_request(messages, "model", max_retries=1, sample_index=2) is None  # 回放时未命中视为失败
+    assert sum(server.stats.values()) == 0
@@ -0,0 +1,93 @@
+import json
+import os
+import pickle
+
+import pytest
+
+import pipeline
+from result_journal import ResultJournal, load_journal
+
+
+def test_last_entry_wins_and_partial_lines_are_skipped(tmp_path):
+    path = str(tmp_path / "journal" / "Raw.jsonl")
+    with ResultJournal(path) as journal:
+        journal.append({"id": "q0", "protocol_result": "first"})
+        journal.append({"id": "q1", "protocol_result": "one"})
+        journal.append({"id": "q0", "protocol_result": "second"})
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"id": "q2", "protocol_res')  # 写到一半时中断
+
+    # 重新打开时先补换行，新记录不会接在残缺行后面
+    with ResultJournal(path) as journal:
+        journal.append({"id": "q3", "protocol_result": "three"})
+    assert load_journal(path) == {"q0": {"id": "q0", "protocol_result": "second"},
+                                  "q1": {"id": "q1", "protocol_result": "one"},
+                                  "q3": {"id": "q3", "protocol_result": "three"}}
+
+    with ResultJournal(path, truncate=True):
+        pass
+    assert load_journal(path) == {}
+    assert load_journal(str(tmp_path / "missing.jsonl")) == {}
+
+
+def test_failed_and_foreign_entries_are_rerun(tmp_path):
+    path = str(tmp_path / "Raw.jsonl")
+    with ResultJournal(path) as journal:
+        journal.append({"id": "q0", "protocol_result": "The best answer is (A)"})
+        journal.append({"id": "q1", "protocol_result": None})
+        journal.append({"id": "q2", "protocol_result": "ERROR: timeout"})
+        journal.append({"id": "other", "protocol_result": "(B)"})
+    finished = pipeline._load_finished_results(path, [{"id": f"q{i}"} for i in range(3)])
+    assert list(finished) == ["q0"]
+
+
+def _read_outputs(directory):
+    # 恢复的条目来自日志的 JSON，.pkl 中对象共享方式不同，按内容比较
+    outputs = {}
+    for name in sorted(os.listdir(directory)):
+        if name.startswith("CommonSense_results_"):
+            with open(os.path.join(directory, name), "rb") as f:
+                outputs[name] = pickle.load(f) if name.endswith(".pkl") else f.read()
+    return outputs
+
+
+@pytest.mark.parametrize("mode", ["thread", "async"])
+def test_resume_after_interruption_matches_full_run(tmp_path, monkeypatch, start_fake_server, mode):
+    monkeypatch.chdir(tmp_path)
+    for name, value in (("method", ""), ("use_result_store", False), ("num_shards", 1), ("online_metrics", False)):
+        monkeypatch.setattr(pipeline, name, value)
+    dataset = [{"id": f"q{i:03d}", "question": f"Question {i}?",
+                "choices": [{"label": label, "text": f"{label} {i}"} for label in "ABCDE"],
+                "answerKey": "ABCDE"[i % 5]} for i in range(10)]
+    with open("CommonSense.json", "w", encoding="utf-8") as f:
+        json.dump(dataset, f)
+
+    def run(resume):
+        if mode == "async":
+            return pipeline.main_experiment_async("CommonSense.json", "model", data_length=10, max_concurrency=4,
+                                                  resume=resume)
+        return pipeline.main_experiment("CommonSense.json", "model", data_length=10, num_workers=4, resume=resume)
+
+    start_fake_server()
+    run(resume=False)
+    full = _read_outputs(os.path.join("output", "model"))
+
+    # 模拟中断：每个协议的日志只保留前 4 条，最后一行写到一半，结果文件还没有生成
+    journal_dir = os.path.join("output", "model", "journal")
+    for name in os.listdir(journal_dir):
+        path = os.path.join(journal_dir, name)
+        with open(path, encoding="utf-8") as f:
+            lines = f.readlines()
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(lines[:4])
+            f.write(lines[4][:20])
+    for name in full:
+        os.remove(os.path.join("output", "model", name))
+
+    # 新的模拟服务对第一次收到的请求给出相同的回答，补全后的结果应与完整运行相同
+    server = start_fake_server()
+    results = run(resume=True)
+    protocols = pipeline._protocols_to_run()
+    assert server.stats["ok"] == 6 * len(protocols)
+    assert all(len(items) == 10 for items in results.values())
+    assert _read_outputs(os.path.join("output", "model")) == full
@@ -0,0 +1,27 @@
+import itertools
+
+import pytest
+
+from result_store import _RESULT_FILE_PATTERN
+
+METHODS = ["", "role", "reflection", "self-consistency", "-logprobs", "role-logprobs", "self-consistency-logprobs"]
+PROTOCOLS = ["Raw", "Correct_Guidance", "Wrong_Guidance", "Trust", "Doubt"]
+
+
+@pytest.mark.parametrize("length, method, protocol",
+                         list(itertools.product(["5000", "1000", "30"], METHODS, PROTOCOLS)))
+def test_result_file_pattern_splits_method_and_protocol(length, method, protocol):
+    name = f"CommonSense_results_{length}{method}_{protocol}.json"
+    match = _RESULT_FILE_PATTERN.match(name)
+    assert match is not None
+    assert match.groups() == (length, method, protocol)
+
+
+@pytest.mark.parametrize("name", [
+    "CommonSense_results_5000_Unknown.json",
+    "CommonSense_results_5000_Raw.pkl",
+    "CommonSense_results_5000role_Trust.json.part",
+    "token_usage_5000.json",
+])
+def test_result_file_pattern_rejects_other_files(name):
+    assert _RESULT_FILE_PATTERN.match(name) is None
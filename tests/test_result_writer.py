@@ -0,0 +1,122 @@
+import json
+import pickle
+import random
+
+import pytest
+
+from result_writer import ResultWriter, read_status, to_json_item
+
+
+def _items(n):
+    return [{"id": f"q{i:03d}", "q_content": "...", "answerKey": "A", "protocol_result": f"(A) answer {i}"}
+            for i in range(n)]
+
+
+def _finalize(item):
+    new_item = dict(item)
+    new_item["model_ans"] = "A"
+    return new_item
+
+
+def _write(tmp_path, items, **kwargs):
+    writer = ResultWriter(str(tmp_path), "CommonSense_results_", "_Raw", _finalize, **kwargs)
+    for item in items:
+        writer.add(item)
+    return writer.close()
+
+
+def _by_id(item):
+    return item["id"]
+
+
+@pytest.mark.parametrize("json_indent", [4, None])
+def test_sorted_output_matches_json_dump(tmp_path, json_indent):
+    items = _items(20)
+    shuffled = random.Random(0).sample(items, len(items))
+    pkl_path, json_path = _write(tmp_path, shuffled, json_indent=json_indent, sort_key=_by_id)
+
+    expected = [to_json_item(_finalize(item)) for item in items]
+    with open(json_path, encoding="utf-8") as f:
+        assert f.read() == json.dumps(expected, ensure_ascii=False, indent=json_indent)
+    with open(pkl_path, "rb") as f:
+        assert [item["id"] for item in pickle.load(f)] == [item["id"] for item in items]
+
+
+def test_sorted_output_does_not_depend_on_arrival_order(tmp_path):
+    items = _items(50)
+    outputs = []
+    for seed in range(3):
+        directory = tmp_path / str(seed)
+        pkl_path, json_path = _write(directory, random.Random(seed).sample(items, len(items)), sort_key=_by_id)
+        with open(pkl_path, "rb") as f_pkl, open(json_path, "rb") as f_json:
+            outputs.append((f_pkl.read(), f_json.read()))
+    assert outputs[0] == outputs[1] == outputs[2]
+
+
+def test_without_sort_key_keeps_arrival_order(tmp_path):
+    items = list(reversed(_items(5)))
+    _, json_path = _write(tmp_path, items)
+    with open(json_path, encoding="utf-8") as f:
+        assert [item["id"] for item in json.load(f)] == [item["id"] for item in items]
+
+
+def test_file_name_counts_items(tmp_path):
+    pkl_path, json_path = _write(tmp_path, _items(7), sort_key=_by_id)
+    assert pkl_path.endswith("CommonSense_results_7_Raw.pkl")
+    assert json_path.endswith("CommonSense_results_7_Raw.json")
+    assert not list(tmp_path.glob("*.part"))
+
+
+def test_finalize_error_is_raised_by_wait(tmp_path):
+    def finalize(item):
+        raise ValueError("boom")
+
+    writer = ResultWriter(str(tmp_path), "CommonSense_results_", "_Raw", finalize)
+    for item in _items(3):
+        writer.add(item)
+    with pytest.raises(ValueError):
+        writer.close()
+
+
+def test_status_file_is_written_and_cleared(tmp_path):
+    status = {"processed_questions": 3, "expected_questions": 5, "budget_exhausted": True, "complete": False}
+    writer = ResultWriter(str(tmp_path), "CommonSense_results_", "_Raw", _finalize, sort_key=_by_id)
+    for item in _items(3):
+        writer.add(item)
+    writer.finish(status)
+    _, json_path = writer.wait()
+    assert read_status(json_path) == status
+
+    # 不带状态重新保存同名结果时删除旧的状态文件，它描述的是被覆盖的结果
+    assert _write(tmp_path, _items(3))[1] == json_path
+    assert read_status(json_path) is None
+
+
+def test_sorted_output_is_written_once(tmp_path, monkeypatch):
+    writes = []
+    original = ResultWriter._write_json
+
+    def counting_write_json(self, path, pkl_items):
+        writes.append(path)
+        return original(self, path, pkl_items)
+
+    monkeypatch.setattr(ResultWriter, "_write_json", counting_write_json)
+    writer = ResultWriter(str(tmp_path), "CommonSense_results_", "_Raw", _finalize, sort_key=_by_id)
+    for item in reversed(_items(5)):
+        writer.add(item)
+    # 排序写入时结束前不写 .json，结果只缓存在内存中
+    assert not list(tmp_path.glob("*.part"))
+    writer.finish()
+    writer.wait()
+    assert len(writes) == 1
+
+
+def test_sorted_finalize_error_is_raised_by_wait(tmp_path):
+    def finalize(item):
+        raise ValueError("boom")
+
+    writer = ResultWriter(str(tmp_path), "CommonSense_results_", "_Raw", finalize, sort_key=_by_id)
+    for item in _items(3):
+        writer.add(item)
+    with pytest.raises(ValueError):
+        writer.close()
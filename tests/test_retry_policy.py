@@ -0,0 +1,115 @@
+import email.utils
+import time
+
+import httpx
+import openai
+import pytest
+
+from retry_policy import CircuitBreaker, FatalRequestError, RetryPolicy, classify_error, retry_after_seconds
+
+REQUEST = httpx.Request("POST", "http://127.0.0.1/v1/chat/completions")
+
+
+def _status_error(status_code, headers=None):
+    response = httpx.Response(status_code, headers=headers or {}, request=REQUEST)
+    return openai.APIStatusError(f"HTTP {status_code}", response=response, body=None)
+
+
+@pytest.mark.parametrize("exc, kind", [
+    (openai.APIConnectionError(request=REQUEST), "retryable"),
+    (openai.APITimeoutError(request=REQUEST), "retryable"),
+    (_status_error(408), "retryable"),
+    (_status_error(429), "retryable"),
+    (_status_error(500), "retryable"),
+    (_status_error(503), "retryable"),
+    (_status_error(400), "fatal"),
+    (_status_error(401), "fatal"),
+    (_status_error(404), "fatal"),
+    (ValueError("empty content"), "retryable"),
+    (FatalRequestError("no logprobs"), "fatal"),
+])
+def test_classify_error(exc, kind):
+    assert classify_error(exc) == kind
+
+
+@pytest.mark.parametrize("status_code, headers, seconds", [
+    (429, {"retry-after-ms": "1500"}, 1.5),
+    (503, {"retry-after": "2"}, 2.0),
+    (429, {"retry-after": "1m30s"}, 90.0),
+    (429, {"retry-after-ms": "250", "retry-after": "9"}, 0.25),
+    (429, {"x-ratelimit-reset-requests": "6m0s", "x-ratelimit-reset-tokens": "20ms"}, 360.0),
+    (503, {"x-ratelimit-reset-requests": "6m0s"}, None),
+    (429, {"retry-after": "soon"}, None),
+    (429, {}, None),
+])
+def test_retry_after_seconds(status_code, headers, seconds):
+    assert retry_after_seconds(_status_error(status_code, headers)) == seconds
+
+
+def test_retry_after_http_date():
+    when = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < retry_after_seconds(_status_error(429, {"retry-after": when})) <= 30
+    past = email.utils.formatdate(time.time() - 30, usegmt=True)
+    assert retry_after_seconds(_status_error(429, {"retry-after": past})) == 0.0
+    assert retry_after_seconds(ValueError("no response")) is None
+
+
+def test_compute_delay_bounds():
+    policy = RetryPolicy(max_delay=10.0)
+    for attempt in range(1, 8):
+        delay, retry_after = policy.compute_delay(attempt, ValueError(), 2.0)
+        assert retry_after is None and 0 <= delay <= min(10.0, 2.0 * 2 ** (attempt - 1))
+    delay, retry_after = policy.compute_delay(1, _status_error(429, {"retry-after": "3"}), 2.0)
+    assert retry_after == 3.0 and 3.0 <= delay <= 5.0
+
+
+def _failing(errors, result="ok"):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    return fn, calls
+
+
+def test_call_retries_retryable_errors():
+    fn, calls = _failing([_status_error(500), openai.APIConnectionError(request=REQUEST)])
+    seen = []
+    assert RetryPolicy().call(fn, max_retries=5, base_delay=0.0,
+                              on_error=lambda attempt, exc, kind: seen.append((attempt, kind))) == "ok"
+    assert len(calls) == 3
+    assert seen == [(1, "retryable"), (2, "retryable")]
+
+
+def test_call_stops_on_fatal_error_and_after_max_retries():
+    fn, calls = _failing([_status_error(400)])
+    with pytest.raises(openai.APIStatusError):
+        RetryPolicy().call(fn, max_retries=5, base_delay=0.0)
+    assert len(calls) == 1
+
+    fn, calls = _failing([_status_error(503)] * 10)
+    with pytest.raises(openai.APIStatusError):
+        RetryPolicy().call(fn, max_retries=3, base_delay=0.0)
+    assert len(calls) == 3
+
+
+def test_retry_after_pauses_the_breaker_for_its_duration():
+    breaker = CircuitBreaker(min_requests=100)
+    policy = RetryPolicy(breaker=breaker)
+    assert policy._on_failure(1, _status_error(429, {"retry-after-ms": "300"}), 5, 0.0, None) == pytest.approx(0.3)
+    assert 0.2 < breaker.remaining() <= 0.3
+    assert breaker.trips == 0
+
+
+def test_breaker_trips_at_error_threshold():
+    breaker = CircuitBreaker(window=10, error_threshold=0.5, min_requests=4, cooldown=60.0)
+    for success in (True, True, False):
+        breaker.record(success)
+    assert breaker.remaining() == 0
+    breaker.record(False)  # 4 次中 2 次失败
+    assert breaker.trips == 1 and breaker.remaining() > 59
+    breaker.record(False)  # 熔断期间不重复打开
+    assert breaker.trips == 1
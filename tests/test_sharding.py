@@ -0,0 +1,113 @@
+import json
+import os
+import random
+
+import pytest
+
+import pipeline
+from sharding import (ShardWriter, merge_shards, read_shard, select_shard, shard_files, shard_label, shard_of,
+                      verify_shards)
+
+IDS = [f"q{i:03d}" for i in range(40)]
+
+
+def _write_shards(directory, items, num_shards, seed=0):
+    rng = random.Random(seed)
+    paths = []
+    for shard_index in range(num_shards):
+        shard_items = [item for item in items if shard_of(item["id"], num_shards) == shard_index]
+        rng.shuffle(shard_items)  # 各节点的完成顺序不同
+        path = os.path.join(directory, f"results.{shard_label(shard_index, num_shards)}.jsonl")
+        writer = ShardWriter(path)
+        for item in shard_items:
+            writer.add(item)
+        paths.append(writer.close())
+    return paths
+
+
+def test_shard_of_is_stable_and_partitions_the_dataset():
+    # 分片只由 id 决定，各机器、各进程必须得到相同的结果
+    assert [shard_of(qa_id, 7) for qa_id in IDS[:8]] == [2, 2, 1, 3, 1, 3, 6, 0]
+    dataset = [{"id": qa_id} for qa_id in IDS]
+    shards = [select_shard(dataset, i, 4) for i in range(4)]
+    assert sorted(item["id"] for shard in shards for item in shard) == IDS
+    with pytest.raises(ValueError):
+        select_shard(dataset, 4, 4)
+
+
+@pytest.mark.parametrize("num_shards", [1, 3, 5])
+def test_merge_is_sorted_and_independent_of_shard_count_and_order(tmp_path, num_shards):
+    items = [{"id": qa_id, "protocol_result": f"answer {qa_id}"} for qa_id in IDS]
+    merged = []
+    for seed in range(2):
+        directory = tmp_path / f"{num_shards}-{seed}"
+        paths = _write_shards(str(directory), random.Random(seed).sample(items, len(items)), num_shards, seed)
+        assert shard_files(str(directory), "results") == sorted(paths)
+        assert verify_shards(paths, IDS, num_shards)["ok"]
+        merged.append(merge_shards(paths))
+    assert merged[0] == merged[1] == items
+
+
+def test_verify_shards_reports_problems(tmp_path):
+    items = [{"id": qa_id, "protocol_result": "ok"} for qa_id in IDS]
+    paths = _write_shards(str(tmp_path), items, 3)
+
+    report = verify_shards(paths[:2], IDS, 3)
+    assert not report["ok"] and report["missing_shards"] == [2] and report["missing_ids"]
+
+    with open(paths[0], "a", encoding="utf-8") as f:
+        f.write(json.dumps(read_shard(paths[1])[0]) + "\n")  # 另一个分片的问题
+    report = verify_shards(paths, IDS, 3)
+    assert not report["ok"] and report["misplaced_ids"] and report["duplicate_ids"]
+
+    report = verify_shards(paths, IDS, 4)
+    assert not report["ok"] and len(report["extra_files"]) == 3
+
+
+def _read_outputs(directory):
+    outputs = {}
+    for name in sorted(os.listdir(directory)):
+        if name.startswith("CommonSense_results_"):
+            with open(os.path.join(directory, name), "rb") as f:
+                outputs[name] = f.read()
+    return outputs
+
+
+def test_merged_files_are_byte_identical_to_single_node(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name, value in (("method", ""), ("use_result_store", False), ("json_indent", 4), ("shard_index", 0)):
+        monkeypatch.setattr(pipeline, name, value)
+    dataset = [{"id": qa_id, "question": f"Question {qa_id}?",
+                "choices": [{"label": label, "text": f"{label} {qa_id}"} for label in "ABCDE"],
+                "answerKey": "ABCDE"[i % 5]} for i, qa_id in enumerate(IDS)]
+    with open("CommonSense.json", "w", encoding="utf-8") as f:
+        json.dump(dataset, f)
+    data_length = len(dataset)
+
+    def run(num_shards):
+        monkeypatch.setattr(pipeline, "num_shards", num_shards)
+        qa_dataset = pipeline.load_data("CommonSense.json", data_length)
+        for shard_index in range(num_shards):
+            monkeypatch.setattr(pipeline, "shard_index", shard_index)
+            for protocol_type in pipeline._protocols_to_run():
+                writer = pipeline.open_result_writer("model", protocol_type, data_length=data_length)
+                items = pipeline._shard_items(qa_dataset)
+                for qa_item in random.Random(shard_index).sample(items, len(items)):
+                    entry = pipeline._new_result_entry(qa_item)
+                    entry["q_content"] = f"prompt for {qa_item['id']}"
+                    entry["protocol_result"] = f'The best answer is: "({qa_item["answerKey"]}) x"'
+                    writer.add(entry)
+                writer.finish(pipeline._protocol_status(len(items), len(items)))
+                writer.wait()
+
+    run(1)
+    single = _read_outputs(os.path.join("output", "model"))
+    os.rename("output", "output-single")
+
+    run(3)
+    monkeypatch.setattr(pipeline, "num_shards", 3)
+    pipeline.merge_shard_results("CommonSense.json", "model", data_length)
+    merged = _read_outputs(os.path.join("output", "model"))
+
+    assert len(single) == 3 * len(pipeline._protocols_to_run())
+    assert merged == single
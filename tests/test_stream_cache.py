@@ -0,0 +1,43 @@
+import fake_llm_server
+import pipeline
+from response_cache import ResponseCache
+
+QA_ITEM = {"id": "q000", "question": "Where do fish live?",
+           "choices": [{"label": label, "text": text} for label, text in
+                       zip("ABCDE", ["a river", "a tree", "a car", "a cloud", "a desk"])],
+           "answerKey": "A"}
+
+
+def test_stopped_stream_is_not_replayed_as_full_response(tmp_path, monkeypatch, start_fake_server):
+    # 答案后面附加足够长的解释，流式请求会在宽限窗口后提前结束
+    monkeypatch.setattr(fake_llm_server, "explanation_chars", 400)
+    cache = ResponseCache(str(tmp_path / "cache"))
+    for name, value in (("response_cache", cache), ("method", ""), ("stream_mode", True), ("stream_grace_chars", 8)):
+        monkeypatch.setattr(pipeline, name, value)
+    server = start_fake_server()
+    messages = pipeline.build_protocol_messages(QA_ITEM, "Raw")
+
+    partial = pipeline.my_request(messages, "model", max_retries=1)
+    stopped_key = pipeline._cache_key(messages, "model", 0, stopped_early=True)
+    assert cache.get(pipeline._cache_key(messages, "model", 0)) is None
+    assert cache.get(stopped_key) == partial
+
+    # 相同宽限窗口的流式请求从缓存回放
+    assert pipeline.my_request(messages, "model", max_retries=1) == partial
+    assert server.stats["ok"] == 1
+
+    # 非流式请求需要完整回答，不使用提前结束的缓存
+    monkeypatch.setattr(pipeline, "stream_mode", False)
+    full = pipeline.my_request(messages, "model", max_retries=1)
+    assert server.stats["ok"] == 2
+    assert len(full) > len(partial)
+    assert cache.get(pipeline._cache_key(messages, "model", 0)) == full
+
+    # 有完整回答后，流式请求也直接使用它
+    monkeypatch.setattr(pipeline, "stream_mode", True)
+    assert pipeline.my_request(messages, "model", max_retries=1) == full
+    assert server.stats["ok"] == 2
+
+    # 宽限窗口不同的流式请求不回放另一个窗口截断的回答
+    monkeypatch.setattr(pipeline, "stream_grace_chars", 16)
+    assert pipeline._cache_key(messages, "model", 0, stopped_early=True) != stopped_key
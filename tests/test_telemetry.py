@@ -0,0 +1,29 @@
+import json
+import time
+
+import pipeline
+from telemetry import Telemetry
+
+
+def test_async_queue_wait_does_not_grow_with_queue_position(tmp_path, monkeypatch, start_fake_server):
+    monkeypatch.chdir(tmp_path)
+    telemetry = Telemetry(str(tmp_path / "telemetry"))
+    for name, value in (("method", ""), ("use_result_store", False), ("num_shards", 1),
+                        ("online_metrics", False), ("request_telemetry", telemetry)):
+        monkeypatch.setattr(pipeline, name, value)
+    dataset = [{"id": f"q{i:03d}", "question": f"Question {i}?",
+                "choices": [{"label": label, "text": f"{label} {i}"} for label in "ABCDE"],
+                "answerKey": "ABCDE"[i % 5]} for i in range(30)]
+    with open("CommonSense.json", "w", encoding="utf-8") as f:
+        json.dump(dataset, f)
+    start_fake_server()
+    start = time.monotonic()
+    pipeline.main_experiment_async("CommonSense.json", "model", data_length=30, max_concurrency=2)
+    elapsed = time.monotonic() - start
+
+    # 每个模型的消费协程数等于并发上限，请求不需要等待名额；排队时间不应包含在队列中等待被取出的时间
+    waits = telemetry.snapshot()["histograms"]["llm_request_queue_wait_seconds"]
+    assert sum(h["count"] for h in waits) == 150
+    assert elapsed > 0.5
+    assert max(h["sum"] / h["count"] for h in waits) < 0.05
+    assert max(h["p99"] for h in waits) <= 0.1
@@ -0,0 +1,96 @@
+import json
+import os
+
+import pytest
+
+import pipeline
+from result_writer import read_status
+from token_usage import TokenLedger, reasoning_tokens
+
+USAGE = {"prompt_tokens": 100, "completion_tokens": 40}
+
+
+def test_reasoning_tokens_prefer_reported_counts():
+    usage = {"completion_tokens": 40, "completion_tokens_details": {"reasoning_tokens": 25}}
+    assert reasoning_tokens(usage, "<think>abc</think>answer") == (25, False)
+    # 后端没有返回时按 <think> 块占回答字符数的比例估计
+    assert reasoning_tokens(USAGE, "<think>" + "x" * 13 + "</think>" + "y" * 12) == (13, True)  # 40 个字符中 13 个
+    assert reasoning_tokens(USAGE, "no reasoning") == (0, False)
+
+
+def test_ledger_totals_cost_and_missing_usage():
+    ledger = TokenLedger({"model": {"prompt": 2.0, "completion": 10.0}})
+    ledger.record("model", "", "Raw", USAGE)
+    ledger.record("model", "self-consistency", "Trust", USAGE)
+    ledger.record("model", "self-consistency", "Trust", None, "x" * 40)  # 提前关闭的流式请求
+    ledger.record("other", "", "Raw", USAGE)
+
+    total = ledger.totals("model")
+    assert (total["requests"], total["prompt_tokens"], total["completion_tokens"]) == (3, 200, 90)
+    assert total["usage_estimated"] == 1
+    assert total["total_tokens"] == 290
+    assert total["cost"] == pytest.approx((200 * 2.0 + 90 * 10.0) / 1e6)
+    assert TokenLedger().totals("model")["cost"] is None
+    assert "费用约" in ledger.report("model") and "费用约" not in ledger.report("other")
+
+
+@pytest.mark.parametrize("budget, over", [
+    ({"tokens": 281}, True), ({"tokens": 282}, False),
+    ({"cost": 0.001}, True), ({"cost": 0.002}, False),
+])
+def test_over_budget_by_tokens_or_cost(budget, over):
+    ledger = TokenLedger({"model": {"prompt": 5.0, "completion": 5.0}}, {"model": budget})
+    assert not ledger.over_budget("model")
+    for _ in range(2):
+        ledger.record("model", "", "Raw", USAGE)
+    ledger.record("model", "", "Raw", {"prompt_tokens": 1, "completion_tokens": 0})
+    assert ledger.over_budget("model") == over  # 合计 281 个 token，费用 0.001405
+    assert not ledger.over_budget("other")
+
+
+def test_save_and_load_accumulate(tmp_path):
+    path = str(tmp_path / "usage" / "model.json")
+    ledger = TokenLedger()
+    ledger.record("model", "", "Raw", USAGE)
+    ledger.record("model", "cot", "Doubt", USAGE)
+    ledger.save(path, "model")
+    with open(path, encoding="utf-8") as f:
+        assert sorted(json.load(f)["usage"]) == ["cot", "none"]
+
+    resumed = TokenLedger()
+    resumed.load(str(tmp_path / "missing.json"))
+    resumed.load(path)
+    assert resumed.totals("model") == ledger.totals("model")
+    resumed.load(path)  # 中断后继续运行时接着累加
+    assert resumed.totals("model")["prompt_tokens"] == 2 * ledger.totals("model")["prompt_tokens"]
+
+
+@pytest.mark.parametrize("mode", ["thread", "async"])
+def test_budget_stops_the_run_and_marks_results_incomplete(tmp_path, monkeypatch, start_fake_server, mode):
+    monkeypatch.chdir(tmp_path)
+    for name, value in (("method", ""), ("use_result_store", False), ("num_shards", 1), ("online_metrics", False)):
+        monkeypatch.setattr(pipeline, name, value)
+    dataset = [{"id": f"q{i:03d}", "question": f"Question {i}?",
+                "choices": [{"label": label, "text": f"{label} {i}"} for label in "ABCDE"],
+                "answerKey": "ABCDE"[i % 5]} for i in range(20)]
+    with open("CommonSense.json", "w", encoding="utf-8") as f:
+        json.dump(dataset, f)
+    start_fake_server()
+    ledger = TokenLedger(budgets={"model": {"tokens": 1}})
+    monkeypatch.setattr(pipeline, "token_ledger", ledger)
+
+    if mode == "async":
+        results = pipeline.main_experiment_async("CommonSense.json", "model", data_length=20, max_concurrency=1)
+    else:
+        results = pipeline.main_experiment("CommonSense.json", "model", data_length=20, num_workers=1)
+
+    # 第一个请求就用完预算，之后不再提交新的问题
+    assert 0 < sum(len(items) for items in results.values()) < 20
+    assert ledger.over_budget("model")
+    for protocol_type, items in results.items():
+        status = read_status(os.path.join("output", "model",
+                                          f"CommonSense_results_{len(items)}_{protocol_type}.json"))
+        assert status["budget_exhausted"] and not status["complete"]
+    # 用量随结果一起保存，resume 时接着累加
+    with open(pipeline._token_usage_path("model", 20), encoding="utf-8") as f:
+        assert json.load(f)["total"]["requests"] == ledger.totals("model")["requests"]
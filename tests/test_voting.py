@@ -0,0 +1,86 @@
+import itertools
+import math
+from fractions import Fraction
+
+import pytest
+
+import pipeline
+from answer_extraction import majority_label
+
+
+def _beta_tail(a, b):
+    # P(p > 1/2)，p ~ Beta(a, b)：展开 (1 - x)^(b - 1) 后逐项精确积分
+    def integral(low, high):
+        return sum(Fraction((-1) ** k * math.comb(b - 1, k), a + k) * (high ** (a + k) - low ** (a + k))
+                   for k in range(b))
+
+    return integral(Fraction(1, 2), Fraction(1)) / integral(Fraction(0), Fraction(1))
+
+
+@pytest.mark.parametrize("lead, others", [(0, 0), (1, 0), (3, 0), (3, 2), (4, 1), (5, 5), (2, 7)])
+def test_majority_posterior_matches_beta_tail(lead, others):
+    assert pipeline._majority_posterior(lead, others) == pytest.approx(float(_beta_tail(lead + 1, others + 1)))
+
+
+def test_majority_posterior_is_symmetric_and_monotonic():
+    for lead, others in itertools.product(range(8), repeat=2):
+        assert pipeline._majority_posterior(lead, others) + pipeline._majority_posterior(others, lead) == \
+            pytest.approx(1.0)
+        assert pipeline._majority_posterior(lead + 1, others) > pipeline._majority_posterior(lead, others)
+
+
+def test_votes_needed_without_stop_rule():
+    assert pipeline._votes_needed([], 5) == 5
+    assert pipeline._votes_needed(["A", "A", "A"], 5) == 2
+    assert pipeline._votes_needed(["A"] * 6, 5) == 0
+
+
+@pytest.mark.parametrize("labels, expected", [
+    ([], 3),  # 5 票中至少 3 票相同才能确定
+    (["A"], 2),
+    (["A", "A"], 1),
+    (["A", "A", "A"], 0),
+    (["A", "B"], 2),
+    (["A", "B", "A", "B"], 1),
+    (["", "", ""], 2),
+])
+def test_votes_needed_majority(labels, expected):
+    assert pipeline._votes_needed(labels, 5, "majority") == expected
+
+
+def _simulate(votes, num_votes, stop_rule):
+    labels = []
+    while True:
+        batch = pipeline._votes_needed(labels, num_votes, stop_rule)
+        if batch == 0:
+            return labels
+        assert batch > 0
+        labels += votes[len(labels):len(labels) + batch]
+
+
+@pytest.mark.parametrize("num_votes", [3, 5])
+def test_majority_stop_never_changes_the_winner(num_votes):
+    for votes in itertools.product(["A", "B", "C", ""], repeat=num_votes):
+        votes = list(votes)
+        used = _simulate(votes, num_votes, "majority")
+        assert len(used) <= num_votes
+        assert majority_label(used) == majority_label(votes)
+
+
+def test_votes_needed_batch_is_a_lower_bound():
+    # 批大小是满足停止条件所需的最少票数：少请求一票时，即使全部投给领先选项也不能停止
+    for labels in itertools.product(["A", "B", ""], repeat=3):
+        labels = list(labels)
+        batch = pipeline._votes_needed(labels, 7, "majority")
+        leader = majority_label(labels) or "A"
+        if batch > 1:
+            assert pipeline._votes_needed(labels + [leader] * (batch - 1), 7, "majority") > 0
+
+
+def test_posterior_stops_no_later_than_majority(monkeypatch):
+    monkeypatch.setattr(pipeline, "vote_confidence", 0.8)
+    for votes in itertools.product(["A", "B"], repeat=7):
+        votes = list(votes)
+        assert len(_simulate(votes, 7, "posterior")) <= len(_simulate(votes, 7, "majority"))
+    assert pipeline._votes_needed(["A", "A", "A"], 7, "posterior") == 0
+    assert pipeline._votes_needed(["A", "A", "A"], 7, "majority") > 0
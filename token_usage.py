@@ -0,0 +1,170 @@
+import json
+import os
+import re
+import threading
+
+_THINK_PATTERN = re.compile(r'<think>(.*?)(?:</think>|$)', re.DOTALL)
+
+
+def _field(obj, name):
+    """
+    同时支持 SDK 返回的对象和普通字典。
+    """
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def estimate_tokens(text):
+    """
+    粗略估计 token 数：约 4 个字符一个 token。
+    """
+    return (len(text) + 3) // 4 if text else 0
+
+
+def reasoning_tokens(usage, content):
+    """
+    计算一次响应中的推理 token 数。
+    优先使用 usage.completion_tokens_details.reasoning_tokens；后端没有返回时，
+    按 <think> 推理块占回答字符数的比例从 completion_tokens 中估计。
+    Args:
+        usage: response.usage。
+        content (str): 原始回答内容（未去掉 <think> 块）。
+    Returns:
+        tuple: (推理 token 数, 是否为估计值)。
+    """
+    details = _field(usage, "completion_tokens_details")
+    reported = _field(details, "reasoning_tokens")
+    if reported:
+        return reported, False
+    completion_tokens = _field(usage, "completion_tokens") or 0
+    if not content or not completion_tokens:
+        return 0, False
+    think_chars = sum(len(m) for m in _THINK_PATTERN.findall(content))
+    if think_chars == 0:
+        return 0, False
+    return round(completion_tokens * think_chars / len(content)), True
+
+
+class TokenLedger:
+    """
+    按 (模型, 方法, 协议) 累计 token 用量，推理 token 单独统计。
+    - prices：模型 -> {"prompt": 每百万输入 token 的价格, "completion": 每百万输出 token 的价格}；
+    - budgets：模型 -> {"tokens": token 总数上限} 或 {"cost": 费用上限}，用完后 over_budget 返回 True。
+    只统计实际发送的请求，命中响应缓存的请求不计入。
+    没有返回用量的请求（如解析到答案后提前关闭的流式请求）按回答内容估计输出 token 数，计入 usage_estimated；
+    这些请求的输入 token 数无法得知，不计入。
+    """
+
+    FIELDS = ("requests", "prompt_tokens", "completion_tokens", "reasoning_tokens", "reasoning_estimated",
+              "usage_estimated")
+
+    def __init__(self, prices=None, budgets=None):
+        self.prices = prices or {}
+        self.budgets = budgets or {}
+        self._entries = {}  # (模型, 方法, 协议) -> 各字段计数
+        self._lock = threading.Lock()
+
+    def record(self, model_name, method, protocol_type, usage, content=None):
+        """
+        记录一次响应的用量。usage 为空（后端未返回）时按 content 估计输出 token 数。
+        Args:
+            content (str or list): 原始回答内容，n 采样时为全部样本的列表，用于估计推理 token。
+        """
+        if isinstance(content, list):
+            content = "".join(c or "" for c in content)
+        usage_estimated = usage is None and bool(content)
+        if usage_estimated:
+            usage = {"prompt_tokens": 0, "completion_tokens": estimate_tokens(content)}
+        reasoning, estimated = reasoning_tokens(usage, content)
+        with self._lock:
+            entry = self._entries.setdefault((model_name, method, protocol_type), dict.fromkeys(self.FIELDS, 0))
+            entry["requests"] += 1
+            entry["prompt_tokens"] += _field(usage, "prompt_tokens") or 0
+            entry["completion_tokens"] += _field(usage, "completion_tokens") or 0
+            entry["reasoning_tokens"] += reasoning
+            entry["reasoning_estimated"] += int(estimated)
+            entry["usage_estimated"] += int(usage_estimated)
+
+    def _cost(self, model_name, prompt_tokens, completion_tokens):
+        price = self.prices.get(model_name)
+        if not price:
+            return None
+        return (prompt_tokens * price.get("prompt", 0) + completion_tokens * price.get("completion", 0)) / 1e6
+
+    def totals(self, model_name):
+        """
+        Returns:
+            dict: 模型在所有方法和协议上的合计，含 total_tokens 和 cost（未设置价格时为 None）。
+        """
+        with self._lock:
+            total = dict.fromkeys(self.FIELDS, 0)
+            for (model, _, _), entry in self._entries.items():
+                if model == model_name:
+                    for field in self.FIELDS:
+                        total[field] += entry[field]
+        total["total_tokens"] = total["prompt_tokens"] + total["completion_tokens"]
+        total["cost"] = self._cost(model_name, total["prompt_tokens"], total["completion_tokens"])
+        return total
+
+    def over_budget(self, model_name):
+        """
+        模型的用量是否已达到预算，未设置预算时总是 False。
+        """
+        budget = self.budgets.get(model_name)
+        if not budget:
+            return False
+        total = self.totals(model_name)
+        if "tokens" in budget and total["total_tokens"] >= budget["tokens"]:
+            return True
+        if "cost" in budget and total["cost"] is not None and total["cost"] >= budget["cost"]:
+            return True
+        return False
+
+    def save(self, path, model_name):
+        """
+        把模型的用量写入 JSON 文件，按 方法 -> 协议 分组，并附上合计和预算。
+        """
+        with self._lock:
+            by_method = {}
+            for (model, method, protocol_type), entry in sorted(self._entries.items()):
+                if model == model_name:
+                    item = dict(entry, total_tokens=entry["prompt_tokens"] + entry["completion_tokens"])
+                    item["cost"] = self._cost(model, entry["prompt_tokens"], entry["completion_tokens"])
+                    by_method.setdefault(method or "none", {})[protocol_type] = item
+        data = {"model": model_name, "usage": by_method, "total": self.totals(model_name),
+                "budget": self.budgets.get(model_name)}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(path + ".tmp", path)
+
+    def load(self, path):
+        """
+        读取之前保存的用量并累加到当前账本，用于中断后继续运行时接着统计。文件不存在时不做任何事。
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        with self._lock:
+            for method, protocols in data.get("usage", {}).items():
+                for protocol_type, item in protocols.items():
+                    key = (data["model"], "" if method == "none" else method, protocol_type)
+                    entry = self._entries.setdefault(key, dict.fromkeys(self.FIELDS, 0))
+                    for field in self.FIELDS:
+                        entry[field] += item.get(field, 0)
+
+    def report(self, model_name):
+        """
+        返回模型用量的文字描述。
+        """
+        total = self.totals(model_name)
+        text = (f"{model_name} token 用量：请求 {total['requests']} 次，输入 {total['prompt_tokens']}，"
+                f"输出 {total['completion_tokens']}（其中推理 {total['reasoning_tokens']}），"
+                f"合计 {total['total_tokens']}")
+        if total["cost"] is not None:
+            text += f"，费用约 {total['cost']:.4f}"
+        return text